@@ -3,6 +3,7 @@ from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.conf import settings
 from decimal import Decimal
+import asyncio
 import json
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
@@ -14,7 +15,6 @@ from django.contrib import messages
 from django.http import JsonResponse
 from django.http import HttpResponseNotAllowed
 from django.contrib.auth import logout
-from django.contrib.auth.models import Group
 from django.http import StreamingHttpResponse, HttpResponseForbidden
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_GET
@@ -23,29 +23,36 @@ import stripe
 from billing.models import ConnectedAccountInvoice
 from django.utils import timezone as dj_timezone
 from django.core.mail import send_mail
-
-
-def plan_name_to_role(plan_name: str) -> str:
-    """Map plan name to one of the role groups (lower-case)."""
-    if not plan_name:
-        return 'free'
-    n = plan_name.strip().lower()
-    if 'athlete' in n:
-        return 'athlete'
-    if 'host' in n:
-        return 'host'
-    if 'guest' in n:
-        return 'guest'
-    if 'free' in n:
-        return 'free'
-    return 'free'
+from django.db.models import Q
+from asgiref.sync import async_to_sync
 
 from billing.models import SubscriptionPlan, UserSubscription, SubscriptionPayment
-from billing.stripe_utils import StripeManager
+from billing.stripe_utils import AsyncStripeManager, idempotency_key, stripe_manager
+from billing.tasks import create_subscription_task
+from billing.views import ROLE_CANDIDATES, add_user_groups, plan_name_to_role, remove_user_groups, role_group_id
 from django.utils import timezone
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from datetime import timedelta
+
+# How long a pending or failed subscription request stays on the dashboard
+SUBSCRIPTION_REQUEST_DISPLAY_WINDOW = timedelta(days=7)
 
 
+async def _fetch_dashboard_stripe_data(connected_acct_id):
+    """Fetch the platform account name and the connected account concurrently.
+
+    The connected account is None when no id is given or its lookup fails.
+    """
+    async with AsyncStripeManager() as mgr:
+        if not connected_acct_id:
+            return await mgr.get_account_info(), None
+        account_name, acct = await asyncio.gather(
+            mgr.get_account_info(),
+            mgr.retrieve_account(connected_acct_id),
+            return_exceptions=True,
+        )
+    return account_name, (None if isinstance(acct, Exception) else acct)
+
 class RegisterView(CreateView):
     form_class = CustomUserCreationForm
     template_name = 'registration/register.html'
@@ -57,7 +64,6 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        stripe_mgr = StripeManager()
 
         # Fetch available subscription plans from database
         plans = []
@@ -73,21 +79,22 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         except Exception as e:
             context['stripe_error'] = str(e)
 
-        # Fetch account information
-        account_name = stripe_mgr.get_account_info()
+        # Fetch account information and, if the user has a connected account id,
+        # its status (to determine if onboarding needs to be resumed, e.g. bank
+        # details or verification incomplete). Both Stripe calls run concurrently.
+        connected_acct_id = getattr(self.request.user, 'stripe_connected_account_id', None)
+        fetch_connected = bool(connected_acct_id and getattr(settings, 'STRIPE_SECRET_KEY', None))
+        account_name, acct = async_to_sync(_fetch_dashboard_stripe_data)(connected_acct_id if fetch_connected else None)
         context['plans'] = plans
         context['stripe_account_name'] = account_name
 
-        # If user has connected account id, fetch its status to determine if onboarding
-        # needs to be resumed (e.g. bank details or verification incomplete).
         try:
-            connected_acct_id = getattr(self.request.user, 'stripe_connected_account_id', None)
             context['connected_acct_id'] = connected_acct_id
             context['connected_needs_onboarding'] = False
             context['connected_account'] = None
-            if connected_acct_id and getattr(settings, 'STRIPE_SECRET_KEY', None):
+            # acct is None when the lookup was skipped or failed; keep the defaults then
+            if acct is not None:
                 try:
-                    acct = stripe_mgr.retrieve_account(connected_acct_id)
                     # normalize dict/object
                     acct_dict = acct if isinstance(acct, dict) else acct.to_dict() if hasattr(acct, 'to_dict') else None
                     context['connected_account'] = acct_dict
@@ -122,8 +129,15 @@ class DashboardView(LoginRequiredMixin, TemplateView):
             all_subs = self.request.user.subscriptions.all()
             active_subs = all_subs.filter(status__in=['active', 'trialing'])
             context['active_subscriptions'] = active_subs
+            # Recent subscription requests still being created, or rejected by Stripe
+            context['subscription_requests'] = all_subs.filter(
+                Q(stripe_subscription_id__isnull=True) | ~Q(failure_reason=''),
+                status__in=['incomplete', 'failed'],
+                created_at__gte=timezone.now() - SUBSCRIPTION_REQUEST_DISPLAY_WINDOW,
+            ).order_by('-created_at')
         except Exception:
             context['active_subscriptions'] = []
+            context['subscription_requests'] = []
 
         # Determine user's roles (all matching role groups). Default to ['free'] if none.
         try:
@@ -155,8 +169,9 @@ class UserSubscriptionListView(LoginRequiredMixin, ListView):
     context_object_name = 'subscriptions'
 
     def get_queryset(self):
-        # return all subscriptions for the current user (ordered newest first)
-        return UserSubscription.objects.filter(user=self.request.user).order_by('-created_at')
+        # return all subscriptions for the current user (ordered newest first);
+        # payments are prefetched since the template lists them per subscription
+        return UserSubscription.objects.filter(user=self.request.user).prefetch_related('payments').order_by('-created_at')
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
@@ -237,7 +252,6 @@ def subscriptions_event_stream(request):
 
 class SubscribeView(LoginRequiredMixin, View):
     def get(self, request, price_id):
-        stripe_mgr = StripeManager()
         publishable = getattr(settings, 'STRIPE_PUBLISHABLE_KEY', '')
 
         if not getattr(settings, 'STRIPE_SECRET_KEY', None):
@@ -247,29 +261,29 @@ class SubscribeView(LoginRequiredMixin, View):
         user = request.user
         # Ensure customer exists
         try:
-            customer_id = stripe_mgr.get_or_create_customer(user)
+            customer_id = stripe_manager.get_or_create_customer(user)
         except Exception as e:
             messages.error(request, str(e))
             return redirect('accounts:dashboard')
 
         # List existing payment methods
-        pms = stripe_mgr.list_payment_methods(customer_id)
+        pms = stripe_manager.list_payment_methods(customer_id)
 
         # Create a SetupIntent for new card entry
         try:
-            setup_intent = stripe_mgr.create_setup_intent(customer_id)
+            setup_intent = stripe_manager.create_setup_intent(customer_id)
         except Exception as e:
             messages.error(request, str(e))
             return redirect('accounts:dashboard')
 
         # Retrieve price info for display
         try:
-            price = stripe_mgr.get_price(price_id)
+            price = stripe_manager.get_price(price_id)
         except Exception as e:
             messages.error(request, str(e))
             return redirect('accounts:dashboard')
 
-        price_amount = stripe_mgr.get_price_amount(price)
+        price_amount = stripe_manager.get_price_amount(price)
 
         context = {
             'price_id': price_id,
@@ -282,7 +296,7 @@ class SubscribeView(LoginRequiredMixin, View):
         }
         # Indicate if the current user already has an active subscription for this price
         try:
-            already = UserSubscription.objects.filter(user=request.user, plan__stripe_price_id=price_id).exclude(status='canceled').exists()
+            already = UserSubscription.objects.filter(user=request.user, plan__stripe_price_id=price_id).exclude(status__in=['canceled', 'failed']).exists()
             context['already_subscribed'] = already
         except Exception:
             context['already_subscribed'] = False
@@ -295,7 +309,6 @@ class CreateSubscriptionView(LoginRequiredMixin, View):
         import logging
         logger = logging.getLogger(__name__)
         
-        stripe_mgr = StripeManager()
         price_id = request.POST.get('price_id')
         payment_method = request.POST.get('payment_method')
 
@@ -316,7 +329,7 @@ class CreateSubscriptionView(LoginRequiredMixin, View):
         try:
             logger.debug('Creating subscription for user %s', user)
             # Get or create customer
-            customer_id = stripe_mgr.get_or_create_customer(user)
+            customer_id = stripe_manager.get_or_create_customer(user)
             logger.debug('Customer ID: %s', customer_id)
             # Retrieve or create local SubscriptionPlan BEFORE creating a Stripe subscription
             plan_obj = None
@@ -328,11 +341,11 @@ class CreateSubscriptionView(LoginRequiredMixin, View):
             if not plan_obj:
                 # fetch price from Stripe to populate local plan
                 try:
-                    price = stripe_mgr.get_price(price_id)
+                    price = stripe_manager.get_price(price_id)
                     prod = price.product if hasattr(price, 'product') else None
                     prod_name = prod.get('name') if isinstance(prod, dict) else getattr(prod, 'name', None) if prod else getattr(price, 'id', price_id)
                     unit_amount = getattr(price, 'unit_amount', 0) or 0
-                    amount_decimal = (int(unit_amount) / 100.0) if unit_amount else 0
+                    amount_decimal = Decimal(int(unit_amount)).scaleb(-2) if unit_amount else Decimal('0.00')
                     plan_obj = SubscriptionPlan.objects.create(
                         name=prod_name or price_id,
                         stripe_price_id=price_id,
@@ -340,14 +353,14 @@ class CreateSubscriptionView(LoginRequiredMixin, View):
                         interval=(price.recurring.get('interval') if getattr(price, 'recurring', None) else 'month')
                     )
                 except Exception as e:
-                    logger.exception('Error fetching price to create local plan: %s', str(e))
+                    logger.exception('Error fetching price to create local plan: %s', e)
                     messages.error(request, f'Unable to retrieve price information: {str(e)}')
                     return redirect('accounts:dashboard')
 
             # Prevent duplicate subscriptions to the same plan if user already has a non-cancelled subscription
             try:
                 # Match by stripe price id to be robust even if local plan object lookup differed
-                duplicate_qs = UserSubscription.objects.filter(user=user, plan__stripe_price_id=price_id).exclude(status='canceled')
+                duplicate_qs = UserSubscription.objects.filter(user=user, plan__stripe_price_id=price_id).exclude(status__in=['canceled', 'failed'])
                 if duplicate_qs.exists():
                     logger.info('Duplicate subscription prevented for user %s and price %s', user, price_id)
                     messages.error(request, 'You already have an active subscription for this plan.')
@@ -356,33 +369,24 @@ class CreateSubscriptionView(LoginRequiredMixin, View):
                 # If anything goes wrong with the duplicate check, log and continue conservatively
                 logger.exception('Error checking for duplicate subscriptions for user %s and price_id %s', user, price_id)
 
-            # Create subscription on Stripe
-            sub = stripe_mgr.create_subscription(customer_id, price_id, payment_method)
-            logger.debug('Subscription created: %s', sub.get('id') if isinstance(sub, dict) else getattr(sub, 'id', None))
-
-            # Create or update a minimal local subscription record. Detailed
-            # status, payments and period dates will be populated by webhooks.
-            stripe_sub_id = (sub.get('id') if isinstance(sub, dict) else getattr(sub, 'id', None))
-            stripe_status = (sub.get('status') if isinstance(sub, dict) else getattr(sub, 'status', None))
-            usub, _ = UserSubscription.objects.update_or_create(
-                stripe_subscription_id=stripe_sub_id,
-                defaults={
-                    'user': user,
-                    'plan': plan_obj,
-                    'status': stripe_status or '',
-                }
-            )
-            logger.info('Subscription created successfully for user %s', user)
-
-            # We intentionally do not record invoice/payment details here. The
-            # webhook handler listens for invoice/payment events and will
-            # create SubscriptionPayment rows when appropriate.
+            # Create the subscription on Stripe (attach + create round trips) in a
+            # worker. The pending local record it fills in also carries the
+            # failure reason if Stripe rejects it, so the dashboard can show it.
+            # Detailed status, payments and period dates will be populated by webhooks.
+            usub = UserSubscription.objects.create(user=user, plan=plan_obj, status='incomplete')
+            try:
+                create_subscription_task.delay(usub.pk, customer_id, price_id, payment_method)
+            except Exception:
+                # Nothing will fill the record in; don't let it block a retry
+                usub.delete()
+                raise
+            logger.info('Subscription creation queued for user %s', user)
 
-            messages.success(request, 'Subscription created successfully.')
+            messages.success(request, 'Subscription requested. It will appear on your dashboard once Stripe confirms it.')
             return redirect('accounts:dashboard')
 
         except Exception as e:
-            logger.exception('Error creating subscription: %s', str(e))
+            logger.exception('Error creating subscription: %s', e)
             messages.error(request, f'Error creating subscription: {str(e)}')
             return redirect('accounts:subscribe', price_id=price_id)
 
@@ -391,8 +395,6 @@ class CancelSubscriptionView(LoginRequiredMixin, View):
     """Cancel a Stripe subscription either immediately or at period end."""
 
     def post(self, request, sub_id):
-        stripe_mgr = StripeManager()
-
         if not getattr(settings, 'STRIPE_SECRET_KEY', None):
             messages.error(request, 'Stripe secret key not configured.')
             return redirect('accounts:dashboard')
@@ -420,27 +422,21 @@ class CancelSubscriptionView(LoginRequiredMixin, View):
                 else:
                     # Request immediate cancellation at Stripe and let webhook update local state
                     try:
-                        stripe_mgr.cancel_subscription(sub_id, at_period_end=False)
+                        stripe_manager.cancel_subscription(sub_id, at_period_end=False)
                         success_msg = 'Requested immediate cancellation — will be reflected after webhook processing.'
                         messages.success(request, success_msg)
                         # Immediately remove the role corresponding to this subscription's plan
                         try:
                             # Determine role from local subscription plan
                             role = plan_name_to_role(usub.plan.name if usub.plan else None)
-                            g = Group.objects.filter(name=role).first()
-                            if g and request.user.groups.filter(pk=g.pk).exists():
-                                request.user.groups.remove(g)
+                            # One query for the user's current role groups; the rest is set logic
+                            current = set(request.user.groups.filter(name__in=ROLE_CANDIDATES).values_list('name', flat=True))
+                            if role in current:
+                                remove_user_groups(request.user, [role_group_id(role)])
+                                current.discard(role)
                                 # If user now has no role groups among candidates, add 'free'
-                                role_candidates = ['free', 'athlete', 'host', 'guest']
-                                has_role = False
-                                for r in role_candidates:
-                                    gg = Group.objects.filter(name=r).first()
-                                    if gg and request.user.groups.filter(pk=gg.pk).exists():
-                                        has_role = True
-                                        break
-                                if not has_role:
-                                    free_group, _ = Group.objects.get_or_create(name='free')
-                                    request.user.groups.add(free_group)
+                                if not current:
+                                    add_user_groups(request.user, [role_group_id('free')])
                         except Exception:
                             pass
                         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -454,7 +450,7 @@ class CancelSubscriptionView(LoginRequiredMixin, View):
             else:
                 # Cancel at period end
                 try:
-                    stripe_mgr.cancel_subscription(sub_id, at_period_end=True)
+                    stripe_manager.cancel_subscription(sub_id, at_period_end=True)
                     success_msg = 'Requested cancellation at period end — will be reflected after webhook processing.'
                     messages.success(request, success_msg)
                     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -479,7 +475,6 @@ class RefreshSubscriptionsAPIView(LoginRequiredMixin, View):
 
     def post(self, request):
         """Sync subscription data from Stripe to local DB and return updated count."""
-        stripe_mgr = StripeManager()
         user = request.user
         updated_count = 0
         errors = []
@@ -492,8 +487,8 @@ class RefreshSubscriptionsAPIView(LoginRequiredMixin, View):
 
                 try:
                     # Fetch latest subscription data from Stripe
-                    remote = stripe_mgr.retrieve_subscription(usub.stripe_subscription_id)
-                    data = stripe_mgr.extract_subscription_data(remote)
+                    remote = stripe_manager.retrieve_subscription(usub.stripe_subscription_id, fresh=True)
+                    data = stripe_manager.extract_subscription_data(remote)
 
                     # Check for updates
                     updated = False
@@ -514,7 +509,7 @@ class RefreshSubscriptionsAPIView(LoginRequiredMixin, View):
                         updated = True
 
                     if updated:
-                        usub.save()
+                        usub.save(update_fields=['status', 'current_period_start', 'current_period_end', 'cancel_at_period_end', 'cancelled_at', 'updated_at'])
                         updated_count += 1
 
                 except Exception as e:
@@ -554,13 +549,11 @@ def connect_start(request):
     - Creates a Stripe connected account (Express) if the user doesn't have one.
     - Generates an account link and redirects the user to Stripe's onboarding flow.
     """
-    stripe_mgr = StripeManager()
-
     user = request.user
     try:
         acct_id = getattr(user, 'stripe_connected_account_id', None)
         if not acct_id:
-            acct = stripe_mgr.create_connected_account()
+            acct = stripe_manager.create_connected_account()
             acct_id = acct.get('id') if isinstance(acct, dict) else getattr(acct, 'id', None)
             if acct_id:
                 user.stripe_connected_account_id = acct_id
@@ -570,7 +563,7 @@ def connect_start(request):
         refresh_url = request.build_absolute_uri(reverse('accounts:connect_refresh'))
         return_url = request.build_absolute_uri(reverse('accounts:connect_return'))
 
-        link = stripe_mgr.create_account_link(acct_id, refresh_url=refresh_url, return_url=return_url)
+        link = stripe_manager.create_account_link(acct_id, refresh_url=refresh_url, return_url=return_url)
         link_url = link.get('url') if isinstance(link, dict) else getattr(link, 'url', None)
         if link_url:
             return redirect(link_url)
@@ -601,7 +594,6 @@ def connect_return(request):
 @login_required
 def connect_info(request):
     """Display Stripe connected account details on a separate page."""
-    stripe_mgr = StripeManager()
     context = {}
     try:
         connected_acct_id = getattr(request.user, 'stripe_connected_account_id', None)
@@ -610,7 +602,7 @@ def connect_info(request):
         context['connected_account'] = None
         if connected_acct_id and getattr(settings, 'STRIPE_SECRET_KEY', None):
             try:
-                acct = stripe_mgr.retrieve_account(connected_acct_id)
+                acct = stripe_manager.retrieve_account(connected_acct_id)
                 acct_dict = acct if isinstance(acct, dict) else acct.to_dict() if hasattr(acct, 'to_dict') else None
                 context['connected_account'] = acct_dict
                 # Extract dashboard timezone if present. Check common locations:
@@ -681,8 +673,6 @@ def connect_info(request):
 def connect_remove(request):
     """Remove the connected Stripe account: delete on Stripe and clear user's field."""
     from django.http import HttpResponseNotAllowed
-    stripe_mgr = StripeManager()
-
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
 
@@ -694,8 +684,8 @@ def connect_remove(request):
     try:
         # Attempt to delete on Stripe
         try:
-            # Use the StripeManager helper which sets API key
-            stripe_mgr.delete_connected_account(acct_id)
+            # Use the shared StripeManager helper
+            stripe_manager.delete_connected_account(acct_id)
         except Exception as e:
             # Report Stripe error and do not clear local reference
             messages.error(request, f'Error deleting connected account on Stripe: {str(e)}')
@@ -727,7 +717,6 @@ def invoices_view(request):
     `ConnectedAccountInvoice` model. It requires that the current user has
     `stripe_connected_account_id` set and the platform `STRIPE_SECRET_KEY`.
     """
-    stripe_mgr = StripeManager()
     connected_acct_id = getattr(request.user, 'stripe_connected_account_id', None)
     invoices = []
     page_obj = None
@@ -790,13 +779,12 @@ def invoices_view(request):
             if not getattr(settings, 'STRIPE_SECRET_KEY', None):
                 raise Exception('Stripe secret key not configured.')
 
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-
             # Create customer on connected account
             cust = stripe.Customer.create(
                 email=email,
                 name=email,
-                stripe_account=connected_acct_id
+                stripe_account=connected_acct_id,
+                idempotency_key=idempotency_key('connected_invoice_customer', record.pk),
             )
 
             # Create invoice first (draft state)
@@ -805,7 +793,8 @@ def invoices_view(request):
                 collection_method='send_invoice',
                 days_until_due=7,
                 auto_advance=False,  # Prevent auto-finalization
-                stripe_account=connected_acct_id
+                stripe_account=connected_acct_id,
+                idempotency_key=idempotency_key('connected_invoice', record.pk),
             )
 
             # Add invoice item to the draft invoice
@@ -815,11 +804,16 @@ def invoices_view(request):
                 amount=amt_cents,
                 currency=currency.lower(),
                 description=description,
-                stripe_account=connected_acct_id
+                stripe_account=connected_acct_id,
+                idempotency_key=idempotency_key('connected_invoice_item', record.pk),
             )
 
             # Now finalize the invoice to generate hosted payment URL
-            finalized = stripe.Invoice.finalize_invoice(invoice.id, stripe_account=connected_acct_id)
+            finalized = stripe.Invoice.finalize_invoice(
+                invoice.id,
+                stripe_account=connected_acct_id,
+                idempotency_key=idempotency_key('finalize_invoice', invoice.id),
+            )
 
             # Get hosted invoice URL
             hosted_url = finalized.get('hosted_invoice_url') if isinstance(finalized, dict) else getattr(finalized, 'hosted_invoice_url', None)
@@ -828,7 +822,7 @@ def invoices_view(request):
             record.stripe_invoice_id = finalized.get('id') if isinstance(finalized, dict) else getattr(finalized, 'id', None)
             record.hosted_invoice_url = hosted_url
             record.invoice_pdf_url = finalized.get('invoice_pdf') if isinstance(finalized, dict) else getattr(finalized, 'invoice_pdf', None)
-            record.save()
+            record.save(update_fields=['stripe_invoice_id', 'hosted_invoice_url', 'invoice_pdf_url'])
 
             # Send email with payment link
             if hosted_url:
@@ -856,7 +850,7 @@ def invoices_view(request):
             # Update record status to error
             record.status = 'error'
             record.metadata = {'error': str(e)}
-            record.save()
+            record.save(update_fields=['status', 'metadata'])
             messages.error(request, f'Error creating invoice: {str(e)}')
             return redirect('accounts:invoices')
 
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 class BillingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'billing'
+
+    def ready(self):
+        # Fail at startup rather than on the first webhook or Stripe call
+        if not settings.DEBUG:
+            for name in ('STRIPE_SECRET_KEY', 'STRIPE_WEBHOOK_SECRET'):
+                if not getattr(settings, name, None):
+                    raise ImproperlyConfigured(f'{name} must be set when DEBUG is off.')
@@ -69,27 +69,33 @@ class Command(BaseCommand):
         
         self.stdout.write(f"Found {invoices.count()} invoice(s):\n")
         
-        for inv in invoices:
-            self.stdout.write(f"Invoice ID: {inv.stripe_invoice_id or '(not created in Stripe yet)'}")
-            self.stdout.write(f"  Status: {inv.status}")
-            self.stdout.write(f"  Amount: {inv.amount} {inv.currency}")
-            self.stdout.write(f"  Email: {inv.customer_email}")
-            self.stdout.write(f"  Connected Account: {inv.connected_account}")
+        # Read-only scan: stream plain dicts instead of hydrating model instances
+        invoices_iter = invoices.values(
+            'stripe_invoice_id', 'status', 'amount', 'currency', 'customer_email',
+            'connected_account', 'paid_at', 'hosted_invoice_url', 'created_at',
+        ).iterator(chunk_size=500)
+
+        for inv in invoices_iter:
+            self.stdout.write(f"Invoice ID: {inv['stripe_invoice_id'] or '(not created in Stripe yet)'}")
+            self.stdout.write(f"  Status: {inv['status']}")
+            self.stdout.write(f"  Amount: {inv['amount']} {inv['currency']}")
+            self.stdout.write(f"  Email: {inv['customer_email']}")
+            self.stdout.write(f"  Connected Account: {inv['connected_account']}")
             
-            if inv.status == 'paid':
-                self.stdout.write(self.style.SUCCESS(f"  ✅ Paid at: {inv.paid_at}"))
+            if inv['status'] == 'paid':
+                self.stdout.write(self.style.SUCCESS(f"  ✅ Paid at: {inv['paid_at']}"))
                 self.stdout.write(self.style.SUCCESS("  → Webhook is working! Invoice marked as paid."))
-            elif inv.status == 'pending':
+            elif inv['status'] == 'pending':
                 self.stdout.write(self.style.WARNING("  ⏳ Status: Pending payment"))
-                self.stdout.write(f"  → Payment link: {inv.hosted_invoice_url}")
+                self.stdout.write(f"  → Payment link: {inv['hosted_invoice_url']}")
                 self.stdout.write("  → Pay this invoice to test webhook")
-            elif inv.status == 'payment_failed':
+            elif inv['status'] == 'payment_failed':
                 self.stdout.write(self.style.ERROR("  ❌ Payment failed"))
                 self.stdout.write("  → Webhook received payment failure event")
             else:
-                self.stdout.write(f"  ℹ️  Status: {inv.status}")
+                self.stdout.write(f"  ℹ️  Status: {inv['status']}")
             
-            self.stdout.write(f"  Created: {inv.created_at}")
+            self.stdout.write(f"  Created: {inv['created_at']}")
             self.stdout.write("")
         
         # Summary
@@ -1,10 +1,7 @@
-import logging
 from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
 from billing.models import SubscriptionPayment
-from billing.stripe_utils import StripeManager
-
-
-logger = logging.getLogger(__name__)
+from billing.tasks import fill_invoice_pdfs_chunk
 
 
 class Command(BaseCommand):
@@ -13,59 +10,51 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--limit', type=int, default=0, help='Limit number of records processed (0 = all)')
         parser.add_argument('--dry-run', action='store_true', help='Do not save changes; show what would be updated')
-        parser.add_argument('--batch', type=int, default=50, help='Number of records to process per iteration (for logging)')
+        parser.add_argument('--batch', type=int, default=1000, help='Size of the payment id range handled by each task')
+        parser.add_argument('--inline', action='store_true', help='Process chunks in this process instead of enqueueing Celery tasks')
 
     def handle(self, *args, **options):
         limit = options.get('limit') or 0
         dry_run = options.get('dry_run')
-        batch = options.get('batch') or 50
-
-        stripe_mgr = StripeManager()
+        batch = options.get('batch') or 1000
+        inline = options.get('inline')
 
         qs = SubscriptionPayment.objects.filter(stripe_invoice_id__isnull=False, invoice_pdf_url__isnull=True).order_by('id')
         total_to_process = qs.count()
         if limit and limit > 0:
-            qs = qs[:limit]
             total_to_process = min(total_to_process, limit)
 
         self.stdout.write(self.style.NOTICE(f'Found {total_to_process} payments missing invoice_pdf_url'))
+        if not total_to_process:
+            return
 
+        bounds = qs.aggregate(lo=Min('id'), hi=Max('id'))
+        id_min = bounds['lo']
+        id_max = bounds['hi'] + 1
+        if limit and limit > 0:
+            # Stop the last range right after the limit-th matching payment
+            id_max = qs.values_list('id', flat=True)[total_to_process - 1] + 1
+
+        chunks = 0
         processed = 0
         updated = 0
         failed = 0
 
-        for p in qs.iterator():
-            processed += 1
-            invoice_id = p.stripe_invoice_id
-            if not invoice_id:
+        for lo in range(id_min, id_max, batch):
+            hi = min(lo + batch, id_max)
+            chunks += 1
+            if not inline:
+                fill_invoice_pdfs_chunk.delay(lo, hi, dry_run)
                 continue
 
-            try:
-                # Try to retrieve invoice via StripeManager which expands payment_intent/charges
-                full_invoice = stripe_mgr.retrieve_invoice(invoice_id)
-                # full_invoice may be dict-like or object
-                invoice_pdf = None
-                if isinstance(full_invoice, dict):
-                    invoice_pdf = full_invoice.get('invoice_pdf') or full_invoice.get('hosted_invoice_url')
-                else:
-                    invoice_pdf = getattr(full_invoice, 'invoice_pdf', None) or getattr(full_invoice, 'hosted_invoice_url', None)
-
-                if invoice_pdf:
-                    self.stdout.write(f'[{processed}/{total_to_process}] Invoice {invoice_id}: found PDF URL')
-                    if not dry_run:
-                        p.invoice_pdf_url = invoice_pdf
-                        p.save(update_fields=['invoice_pdf_url'])
-                        updated += 1
-                else:
-                    self.stdout.write(f'[{processed}/{total_to_process}] Invoice {invoice_id}: no PDF/hosted URL available')
-
-            except Exception as e:
-                failed += 1
-                logger.exception('Error fetching invoice %s: %s', invoice_id, str(e))
-                self.stdout.write(self.style.WARNING(f'[{processed}/{total_to_process}] Failed to fetch invoice {invoice_id}: {e}'))
+            result = fill_invoice_pdfs_chunk(lo, hi, dry_run)
+            processed += result['processed']
+            updated += result['updated']
+            failed += result['failed']
+            self.stdout.write(f'Processed {processed}/{total_to_process} (updated: {updated}, failed: {failed})')
 
-            # Periodic progress
-            if processed % batch == 0:
-                self.stdout.write(f'Processed {processed}/{total_to_process} (updated: {updated}, failed: {failed})')
+        if not inline:
+            self.stdout.write(self.style.SUCCESS(f'Enqueued {chunks} chunk(s) of up to {batch} ids (dry_run={dry_run})'))
+            return
 
         self.stdout.write(self.style.SUCCESS(f'Done. Processed={processed}, updated={updated}, failed={failed} (dry_run={dry_run})'))
@@ -4,6 +4,11 @@ import stripe
 from decimal import Decimal
 
 from billing.models import SubscriptionPlan
+from billing.stripe_utils import get_product_name
+
+
+# Stripe amounts are integer cents; multiply by this instead of dividing per price
+CENT = Decimal('0.01')
 
 
 class Command(BaseCommand):
@@ -37,26 +42,18 @@ class Command(BaseCommand):
             if isinstance(product, dict):
                 product_name = product.get('name')
             else:
-                # if product is just id string, attempt to retrieve
-                try:
-                    prod_obj = stripe.Product.retrieve(product)
-                    product_name = prod_obj.get('name')
-                except Exception:
-                    product_name = None
+                # if product is just id string, look up the cached product name
+                product_name = get_product_name(product)
 
             # Price amount and currency
             unit_amount = price.get('unit_amount') or price.get('unit_amount_decimal')
-            if unit_amount is None:
-                price_decimal = Decimal('0.00')
-            else:
-                try:
-                    price_decimal = Decimal(int(unit_amount)) / Decimal(100)
-                except Exception:
-                    price_decimal = Decimal(str(unit_amount))
+            try:
+                price_decimal = (Decimal(int(unit_amount)) * CENT) if unit_amount is not None else Decimal('0.00')
+            except Exception:
+                price_decimal = Decimal(str(unit_amount))
 
             # Interval (e.g. month, year)
-            recurring = price.get('recurring')
-            interval = recurring.get('interval') if recurring else 'month'
+            interval = (price.get('recurring') or {}).get('interval', 'month')
 
             # Check if SubscriptionPlan exists for this price id
             try:
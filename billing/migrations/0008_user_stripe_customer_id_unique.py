@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-15 22:45
+
+from django.db import migrations, models
+
+
+def blank_customer_ids_to_null(apps, schema_editor):
+    # Blank ids would collide under the unique constraint; NULLs do not
+    User = apps.get_model('billing', 'User')
+    User.objects.filter(stripe_customer_id='').update(stripe_customer_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0007_stripe_id_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(blank_customer_ids_to_null, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-15 22:55
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0008_user_stripe_customer_id_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedStripeEvent',
+            fields=[
+                ('event_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('processed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
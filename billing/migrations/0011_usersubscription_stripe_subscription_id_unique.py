@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-15 23:21
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_subscriptions(apps, schema_editor):
+    # Blank ids would collide under the unique constraint; NULLs do not
+    UserSubscription = apps.get_model('billing', 'UserSubscription')
+    SubscriptionPayment = apps.get_model('billing', 'SubscriptionPayment')
+    UserSubscription.objects.filter(stripe_subscription_id='').update(stripe_subscription_id=None)
+    # Keep the most recently updated row per Stripe subscription and move payments onto it
+    duplicated = (
+        UserSubscription.objects.exclude(stripe_subscription_id=None)
+        .values('stripe_subscription_id').annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('stripe_subscription_id', flat=True)
+    )
+    for sub_id in duplicated:
+        keep, *extra = UserSubscription.objects.filter(stripe_subscription_id=sub_id).order_by('-updated_at', '-id')
+        extra_ids = [u.id for u in extra]
+        SubscriptionPayment.objects.filter(subscription_id__in=extra_ids).update(subscription_id=keep.id)
+        UserSubscription.objects.filter(id__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0010_usersubscription_failure_reason'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='usersubscription',
+            name='stripe_subscription_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -6,9 +6,9 @@ from django.utils import timezone
 
 class User(AbstractUser):
     """Custom user model that stores Stripe customer id for payment linking."""
-    stripe_customer_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_customer_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     # Stripe Connected Account ID for Stripe Connect (e.g. acct_XXXXX)
-    stripe_connected_account_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_connected_account_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
 
 
 class SubscriptionPlan(models.Model):
@@ -28,6 +28,13 @@ class SubscriptionPlan(models.Model):
         return self.name
 
 
+class UserSubscriptionManager(models.Manager):
+    """Default manager that joins the user and plan used by `__str__` and views."""
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('user', 'plan')
+
+
 class UserSubscription(models.Model):
     STATUS_CHOICES = [
         ('trialing', 'Trialing'),
@@ -35,35 +42,50 @@ class UserSubscription(models.Model):
         ('past_due', 'Past Due'),
         ('canceled', 'Canceled'),
         ('incomplete', 'Incomplete'),
+        ('failed', 'Failed'),
     ]
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='subscriptions')
     plan = models.ForeignKey(SubscriptionPlan, on_delete=models.PROTECT)
-    stripe_subscription_id = models.CharField(max_length=255, blank=True, null=True)
+    # Unique so concurrent webhook handlers can't insert the same subscription twice; NULL while pending
+    stripe_subscription_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='incomplete')
     current_period_start = models.DateTimeField(blank=True, null=True)
     current_period_end = models.DateTimeField(blank=True, null=True)
     cancel_at_period_end = models.BooleanField(default=False)
     cancelled_at = models.DateTimeField(blank=True, null=True)
+    # Why creating the subscription (or charging its first invoice) failed, shown on the dashboard
+    failure_reason = models.CharField(max_length=255, blank=True, default='')
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = UserSubscriptionManager()
+
     def __str__(self):
         return f"{self.user} - {self.plan.name} ({self.status})"
 
 
+class SubscriptionPaymentManager(models.Manager):
+    """Default manager that joins the user and subscription plan for listings."""
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('user', 'subscription__plan')
+
+
 class SubscriptionPayment(models.Model):
     subscription = models.ForeignKey(UserSubscription, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=10, default='usd')
-    stripe_invoice_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_invoice_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     invoice_pdf_url = models.URLField(blank=True, null=True)
-    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True)
-    stripe_charge_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    stripe_charge_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     status = models.CharField(max_length=30, default='succeeded')
     created_at = models.DateTimeField(default=timezone.now)
 
+    objects = SubscriptionPaymentManager()
+
     def __str__(self):
         return f"{self.user} - {self.amount} {self.currency} ({self.status})"
 
@@ -74,8 +96,8 @@ class ConnectedAccountInvoice(models.Model):
     This model stores the invoice identifiers and metadata so the platform
     can track invoices that were created/sent on behalf of connected accounts.
     """
-    connected_account = models.CharField(max_length=255)
-    stripe_invoice_id = models.CharField(max_length=255, blank=True, null=True)
+    connected_account = models.CharField(max_length=255, db_index=True)
+    stripe_invoice_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     customer_email = models.EmailField(blank=True, null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     currency = models.CharField(max_length=10, default='USD')
@@ -89,3 +111,16 @@ class ConnectedAccountInvoice(models.Model):
     def __str__(self):
         return f"Invoice {self.stripe_invoice_id or '(local)'} for {self.connected_account} ({self.status})"
 
+
+
+class ProcessedStripeEvent(models.Model):
+    """Stripe webhook event ids whose handlers have already run.
+
+    The primary key makes a redelivered event fail its insert, so workers
+    can skip it without touching Stripe or the other tables.
+    """
+    event_id = models.CharField(max_length=255, primary_key=True)
+    processed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.event_id
@@ -1,31 +1,233 @@
 """
 Stripe utility class to encapsulate all Stripe API interactions.
 Provides clean methods for customer, subscription, and payment operations.
+
+Everything here is network-bound: a Stripe round trip dwarfs the Python
+spent around it, the extract_* helpers included. Optimize by caching
+(Django cache), batching (list calls instead of per-id retrieves),
+running independent calls concurrently (AsyncStripeManager, Celery) and
+reusing pooled connections, not by micro-tuning or compiling the code.
 """
+import hashlib
+import json
+import requests
 import stripe
 from decimal import Decimal
 from django.conf import settings
-from datetime import datetime, timezone
+from django.core.cache import cache
+from django.db import transaction
+from datetime import datetime, timezone as _tz
 import time
+import uuid
+
+try:
+    # Works on bytes end to end: no str round trip when caching Stripe objects
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    _json_dumps, _json_loads = json.dumps, json.loads
+
+_UTC = _tz.utc
+_fromtimestamp = datetime.fromtimestamp
+
+
+# Transient Stripe failures that callers (e.g. Celery tasks) may retry
+RETRYABLE_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError)
+
+# Keep-alive connection pool shared by every Stripe call in this process
+HTTP_POOL_CONNECTIONS = 20
+HTTP_POOL_MAXSIZE = 50
+
+# Bound how long a single Stripe call can block a worker; the SDK retries
+# connection errors and 429s with exponential backoff
+STRIPE_REQUEST_TIMEOUT = 10
+STRIPE_MAX_NETWORK_RETRIES = 3
+
+def _configure_http_client():
+    """Install a pooled, time-bounded requests session as Stripe's HTTP client.
+
+    Also enables the SDK's network retries.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_REQUEST_TIMEOUT, session=session)
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+
+
+# Configure the SDK once per process at import rather than per StripeManager
+if getattr(settings, 'STRIPE_SECRET_KEY', None):
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+_configure_http_client()
+
+
+PRODUCT_NAME_CACHE_TTL = 60 * 60 * 24
+PRICE_CACHE_TTL = 60 * 60 * 24
+PRICE_LIST_CACHE_TTL = 60 * 60
+SUBSCRIPTION_CACHE_TTL = 60 * 5
+INVOICE_CACHE_TTL = 60
+PAYMENT_INTENT_CACHE_TTL = 60
+ACCOUNT_INFO_CACHE_TTL = 60 * 60
+ACTIVE_PRICES_CACHE_KEY = 'stripe_prices:active'
+ACCOUNT_INFO_CACHE_KEY = 'stripe_account:platform'
+
+# Rows per INSERT when bulk-persisting payments during backfills
+PAYMENT_BULK_BATCH_SIZE = 500
+
+
+def _cache_get_json(key):
+    """Return the decoded JSON cached under `key`, or None on a miss or cache error."""
+    try:
+        raw = cache.get(key)
+    except Exception:
+        return None
+    return _json_loads(raw) if raw is not None else None
+
+
+def _cache_set_json(key, value, ttl):
+    """Cache `value` (Stripe objects allowed) as JSON; cache errors are ignored."""
+    try:
+        cache.set(key, _json_dumps(value, default=lambda o: o.to_dict()), ttl)
+    except Exception:
+        pass
+
+
+def _cached_retrieve(key, resource_cls, ttl, fetch):
+    """Return the cached Stripe object under `key`, calling `fetch()` on a miss."""
+    cached = _cache_get_json(key)
+    if cached is not None:
+        return resource_cls.construct_from(cached, stripe.api_key)
+    obj = fetch()
+    _cache_set_json(key, obj, ttl)
+    return obj
+
+
+def _price_cache_key(price_id):
+    return f'stripe_price:{price_id}'
+
+
+def _subscription_cache_key(subscription_id):
+    return f'stripe_sub:{subscription_id}'
+
+
+def invalidate_price(price_id=None):
+    """Drop a cached price (if given) and the cached active price list."""
+    keys = [ACTIVE_PRICES_CACHE_KEY]
+    if price_id:
+        keys.append(_price_cache_key(price_id))
+    try:
+        cache.delete_many(keys)
+    except Exception:
+        pass
+
+
+def invalidate_subscription(subscription_id):
+    """Drop a cached subscription after it changes on Stripe."""
+    if not subscription_id:
+        return
+    try:
+        cache.delete(_subscription_cache_key(subscription_id))
+    except Exception:
+        pass
+
+
+def invalidate_account_info():
+    """Drop the cached platform account name after the account changes on Stripe."""
+    try:
+        cache.delete(ACCOUNT_INFO_CACHE_KEY)
+    except Exception:
+        pass
+
+
+def invalidate_product(product_id, price_ids=()):
+    """Drop a cached product name along with any cached prices that embed it."""
+    keys = [f'stripe:product:{product_id}', ACTIVE_PRICES_CACHE_KEY]
+    keys.extend(_price_cache_key(pid) for pid in price_ids if pid)
+    try:
+        cache.delete_many(keys)
+    except Exception:
+        pass
+
+
+def get_product_name(product_id):
+    """Return a Stripe product's name, cached for a day to avoid repeat lookups.
+
+    Failed lookups return an empty string and are not cached so the next
+    sync retries them.
+    """
+    if not product_id:
+        return ''
+    key = f'stripe:product:{product_id}'
+    try:
+        name = cache.get(key)
+    except Exception:
+        name = None
+    if name is None:
+        try:
+            name = stripe.Product.retrieve(product_id).get('name') or ''
+        except Exception:
+            return ''
+        try:
+            cache.set(key, name, PRODUCT_NAME_CACHE_TTL)
+        except Exception:
+            pass
+    return name
+
+
+def idempotency_key(operation, *parts):
+    """Build a Stripe Idempotency-Key for `operation` from stable identifiers.
+
+    Stripe replays the original response for a repeated key (for 24 hours),
+    so a retried write never creates a duplicate. Pass identifiers that are
+    the same across retries of one logical operation; if none exist, a random
+    token still covers stripe-python's own network retries.
+    """
+    if not parts:
+        parts = (uuid.uuid4().hex,)
+    digest = hashlib.sha256(':'.join(str(p) for p in parts).encode()).hexdigest()
+    return f'{operation}:{digest}'
+
+
+def _account_display_name(acct):
+    """Return the business name of a Stripe account, else its dashboard name."""
+    return _g(_g(acct, 'business_profile'), 'name') or _g(_g(_g(acct, 'settings'), 'dashboard'), 'display_name')
+
+
+def _pm_to_dict(pm):
+    """Flatten a card PaymentMethod into the fields the payment form shows."""
+    card = pm['card']
+    return {
+        'id': pm['id'],
+        'brand': card['brand'],
+        'last4': card['last4'],
+        'exp_month': card['exp_month'],
+        'exp_year': card['exp_year'],
+    }
+
+
+def _g(obj, key, default=None):
+    """Read `key` from a webhook dict or StripeObject (a dict subclass).
+
+    Returns `default` when the key is missing or `obj` is not a mapping
+    (e.g. None or an unexpanded id string).
+    """
+    try:
+        return obj[key] if key in obj else default
+    except TypeError:
+        return default
 
 
 class StripeManager:
     """Centralized manager for Stripe API operations."""
 
-    def __init__(self):
-        """Initialize Stripe API key from settings."""
-        api_key = getattr(settings, 'STRIPE_SECRET_KEY', None)
-        if api_key:
-            stripe.api_key = api_key
-
     def _to_datetime(self, timestamp):
         """Convert Stripe Unix timestamp to timezone-aware datetime."""
-        if timestamp is None or timestamp == '':
+        if not timestamp:
             return None
+        # Stripe sends integer timestamps; only other types need conversion
+        if type(timestamp) is int:
+            return _fromtimestamp(timestamp, _UTC)
         try:
-            # Handle both string and integer timestamps
-            ts = int(timestamp) if isinstance(timestamp, str) else timestamp
-            return datetime.fromtimestamp(ts, tz=timezone.utc)
+            return _fromtimestamp(int(timestamp), _UTC)
         except (ValueError, TypeError, OSError):
             return None
 
@@ -37,37 +239,40 @@ class StripeManager:
             return user.stripe_customer_id
 
         try:
-            customer = stripe.Customer.create(
-                email=user.email,
-                name=user.get_full_name() or user.username
-            )
-            user.stripe_customer_id = customer.id
-            user.save()
-            return customer.id
+            with transaction.atomic():
+                # Lock the user row and re-check so concurrent requests create one customer
+                locked = type(user).objects.select_for_update().get(pk=user.pk)
+                if not locked.stripe_customer_id:
+                    customer = stripe.Customer.create(
+                        email=user.email,
+                        name=user.get_full_name() or user.username,
+                        idempotency_key=idempotency_key('create_customer', user.pk),
+                    )
+                    locked.stripe_customer_id = customer.id
+                    locked.save(update_fields=['stripe_customer_id'])
+            user.stripe_customer_id = locked.stripe_customer_id
+            return user.stripe_customer_id
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to create Stripe customer: {str(e)}')
 
     def list_payment_methods(self, customer_id):
         """List all payment methods for a customer."""
         try:
-            pm_list = stripe.PaymentMethod.list(customer=customer_id, type='card')
-            return [
-                {
-                    'id': m.id,
-                    'brand': m.card.brand,
-                    'last4': m.card.last4,
-                    'exp_month': m.card.exp_month,
-                    'exp_year': m.card.exp_year
-                }
-                for m in pm_list.data
-            ]
+            pm_list = stripe.PaymentMethod.list(customer=customer_id, type='card', limit=100)
+            return list(map(_pm_to_dict, pm_list.auto_paging_iter()))
         except Exception:
             return []
 
     def attach_payment_method(self, payment_method_id, customer_id):
         """Attach a payment method to a customer."""
         try:
-            stripe.PaymentMethod.attach(payment_method_id, customer=customer_id)
+            stripe.PaymentMethod.attach(
+                payment_method_id,
+                customer=customer_id,
+                idempotency_key=idempotency_key('attach_payment_method', payment_method_id, customer_id),
+            )
             return True
         except Exception:
             # Already attached or other error — ignore
@@ -78,26 +283,81 @@ class StripeManager:
     def create_setup_intent(self, customer_id):
         """Create a SetupIntent for capturing payment method."""
         try:
-            return stripe.SetupIntent.create(customer=customer_id)
+            # A fresh key per call: each page load needs its own SetupIntent
+            return stripe.SetupIntent.create(
+                customer=customer_id,
+                idempotency_key=idempotency_key('create_setup_intent'),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to create SetupIntent: {str(e)}')
 
     # ==================== Price Operations ====================
 
     def get_price(self, price_id):
-        """Fetch price details from Stripe."""
+        """Fetch price details (with expanded product), cached for a day."""
         try:
-            return stripe.Price.retrieve(price_id, expand=['product'])
+            return _cached_retrieve(
+                _price_cache_key(price_id), stripe.Price, PRICE_CACHE_TTL,
+                lambda: stripe.Price.retrieve(price_id, expand=['product']),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to fetch price {price_id}: {str(e)}')
 
+    def get_prices(self, price_ids):
+        """Fetch several prices at once, keyed by price id.
+
+        Cached prices are used first; the rest come from a single active price
+        listing instead of one retrieve per id. Ids not found there (e.g.
+        inactive prices) fall back to `get_price` and are skipped on error.
+        """
+        prices = {}
+        missing = []
+        for price_id in dict.fromkeys(price_ids):
+            cached = _cache_get_json(_price_cache_key(price_id))
+            if cached is not None:
+                prices[price_id] = stripe.Price.construct_from(cached, stripe.api_key)
+            else:
+                missing.append(price_id)
+        if not missing:
+            return prices
+
+        wanted = set(missing)
+        try:
+            for price in stripe.Price.list(active=True, limit=100, expand=['data.product']).auto_paging_iter():
+                if price.id in wanted:
+                    prices[price.id] = price
+                    _cache_set_json(_price_cache_key(price.id), price, PRICE_CACHE_TTL)
+                    # Stop paging once every requested price has been seen
+                    wanted.discard(price.id)
+                    if not wanted:
+                        break
+        except Exception:
+            pass
+
+        for price_id in missing:
+            if price_id not in prices:
+                try:
+                    prices[price_id] = self.get_price(price_id)
+                except Exception:
+                    continue
+        return prices
+
     def list_prices(self):
-        """List all active prices from Stripe."""
+        """List all active prices from Stripe, cached for an hour."""
+        cached = _cache_get_json(ACTIVE_PRICES_CACHE_KEY)
+        if cached is not None:
+            return [stripe.Price.construct_from(p, stripe.api_key) for p in cached]
+
         try:
             prices = stripe.Price.list(active=True, limit=100)
-            return prices.data
         except Exception:
             return []
+        _cache_set_json(ACTIVE_PRICES_CACHE_KEY, prices.data, PRICE_LIST_CACHE_TTL)
+        return prices.data
 
     def get_price_amount(self, price):
         """Extract and format price amount from Stripe price object."""
@@ -113,8 +373,12 @@ class StripeManager:
 
     # ==================== Subscription Operations ====================
 
-    def create_subscription(self, customer_id, price_id, payment_method_id):
-        """Create a new subscription for a customer."""
+    def create_subscription(self, customer_id, price_id, payment_method_id, request_token=None):
+        """Create a new subscription for a customer.
+
+        `request_token` identifies the logical request (e.g. the Celery task id)
+        so retries of it reuse one idempotency key; without it each call is new.
+        """
         try:
             # Attach payment method if needed
             self.attach_payment_method(payment_method_id, customer_id)
@@ -130,8 +394,16 @@ class StripeManager:
                 collection_method='charge_automatically',  # Automatic billing
                 billing_cycle_anchor=billing_cycle_anchor,  # Start billing cycle in future
                 proration_behavior='create_prorations',  # Handle prorations
+                # Lets the caller tell a declined or unauthenticated first charge apart
+                expand=['latest_invoice.payment_intent'],
+                idempotency_key=idempotency_key(
+                    'create_subscription', customer_id, price_id, payment_method_id, request_token or uuid.uuid4().hex
+                ),
             )
+            invalidate_subscription(subscription.id)
             return subscription
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to create subscription: {str(e)}')
 
@@ -140,99 +412,120 @@ class StripeManager:
         try:
             if at_period_end:
                 # Schedule cancellation at period end
-                return stripe.Subscription.modify(subscription_id, cancel_at_period_end=True)
+                subscription = stripe.Subscription.modify(
+                    subscription_id,
+                    cancel_at_period_end=True,
+                    idempotency_key=idempotency_key('cancel_subscription_at_period_end', subscription_id),
+                )
             else:
                 # Cancel immediately
-                return stripe.Subscription.delete(subscription_id)
+                subscription = stripe.Subscription.delete(
+                    subscription_id,
+                    idempotency_key=idempotency_key('cancel_subscription', subscription_id),
+                )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to cancel subscription: {str(e)}')
+        invalidate_subscription(subscription_id)
+        return subscription
 
-    def retrieve_subscription(self, subscription_id):
-        """Fetch subscription details from Stripe."""
+    def retrieve_subscription(self, subscription_id, fresh=False):
+        """Fetch subscription details from Stripe, cached for a few minutes.
+
+        Callers that exist to pull current state pass fresh=True to bypass
+        the cache; the fetched object then replaces the cached copy.
+        """
+        key = _subscription_cache_key(subscription_id)
         try:
-            return stripe.Subscription.retrieve(subscription_id)
+            if fresh:
+                sub = stripe.Subscription.retrieve(subscription_id)
+                _cache_set_json(key, sub, SUBSCRIPTION_CACHE_TTL)
+                return sub
+            return _cached_retrieve(
+                key, stripe.Subscription, SUBSCRIPTION_CACHE_TTL,
+                lambda: stripe.Subscription.retrieve(subscription_id),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to retrieve subscription: {str(e)}')
 
     def finalize_invoice(self, invoice_id):
         """Finalize a draft invoice (sends it to be paid)."""
         try:
-            return stripe.Invoice.finalize_invoice(invoice_id)
+            return stripe.Invoice.finalize_invoice(
+                invoice_id,
+                idempotency_key=idempotency_key('finalize_invoice', invoice_id),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to finalize invoice {invoice_id}: {str(e)}')
 
     def extract_subscription_data(self, subscription):
-        """Extract key fields from a subscription object (handles dict or object)."""
-        # Extract current_period_start and current_period_end from items.data[0] (nested)
-        current_period_start = None
-        current_period_end = None
-        price_id = None
-        
-        try:
-            # Handle dict vs object for items
-            if isinstance(subscription, dict):
-                items = subscription.get('items', {}).get('data')
-            else:
-                items_obj = getattr(subscription, 'items', None)
-                items = getattr(items_obj, 'data', None) if items_obj else None
-            
-            # Extract period dates from first subscription item
-            if items and isinstance(items, list) and len(items) > 0:
-                first_item = items[0]
-                if isinstance(first_item, dict):
-                    current_period_start = first_item.get('current_period_start')
-                    current_period_end = first_item.get('current_period_end')
-                    # Also extract price_id from first item
-                    price = first_item.get('price', {})
-                    price_id = price.get('id') if isinstance(price, dict) else getattr(price, 'id', None)
-                else:
-                    current_period_start = getattr(first_item, 'current_period_start', None)
-                    current_period_end = getattr(first_item, 'current_period_end', None)
-                    # Also extract price_id from first item
-                    price = getattr(first_item, 'price', None)
-                    price_id = price.get('id') if isinstance(price, dict) else getattr(price, 'id', None)
-        except Exception:
-            pass
+        """Extract key fields from a subscription webhook dict or StripeObject.
 
-        data = {
-            'id': subscription.get('id') if isinstance(subscription, dict) else getattr(subscription, 'id', None),
-            'customer': subscription.get('customer') if isinstance(subscription, dict) else getattr(subscription, 'customer', None),
-            'status': subscription.get('status') if isinstance(subscription, dict) else getattr(subscription, 'status', None),
-            'current_period_start': self._to_datetime(current_period_start),
-            'current_period_end': self._to_datetime(current_period_end),
-            'cancel_at_period_end': subscription.get('cancel_at_period_end') if isinstance(subscription, dict) else getattr(subscription, 'cancel_at_period_end', False),
-            'canceled_at': self._to_datetime(
-                subscription.get('canceled_at') if isinstance(subscription, dict) else getattr(subscription, 'canceled_at', None)
-            ),
-            'price_id': price_id,
-        }
+        Both are mappings, so every field is read with a plain `.get()`.
+        """
+        to_dt = self._to_datetime
+        get = subscription.get
 
-        return data
+        # Period dates and price id live on the first subscription item
+        items = (get('items') or {}).get('data')
+        first_item = items[0] if items else {}
+
+        return {
+            'id': get('id'),
+            'customer': get('customer'),
+            'status': get('status'),
+            'current_period_start': to_dt(first_item.get('current_period_start')),
+            'current_period_end': to_dt(first_item.get('current_period_end')),
+            'cancel_at_period_end': get('cancel_at_period_end'),
+            'canceled_at': to_dt(get('canceled_at')),
+            'price_id': (first_item.get('price') or {}).get('id'),
+        }
 
     # ==================== Account Operations ====================
 
     def get_account_info(self):
-        """Retrieve Stripe account information."""
+        """Retrieve the platform account's display name, cached for an hour."""
         try:
-            acct = stripe.Account.retrieve()
-            bp = acct.get('business_profile') if isinstance(acct, dict) else getattr(acct, 'business_profile', None)
-            if bp:
-                name = bp.get('name') if isinstance(bp, dict) else getattr(bp, 'name', None)
-                if name:
-                    return name
-
-            # Fallback
-            name = acct.get('settings', {}).get('dashboard', {}).get('display_name') if isinstance(acct, dict) else getattr(acct, 'display_name', None)
+            name = cache.get(ACCOUNT_INFO_CACHE_KEY)
+        except Exception:
+            name = None
+        if name is not None:
             return name
+
+        try:
+            name = _account_display_name(stripe.Account.retrieve())
         except Exception:
             return None
+        if name:
+            try:
+                cache.set(ACCOUNT_INFO_CACHE_KEY, name, ACCOUNT_INFO_CACHE_TTL)
+            except Exception:
+                pass
+        return name
 
     # ==================== Invoice Operations ====================
 
-    def retrieve_invoice(self, invoice_id):
-        """Fetch invoice details from Stripe."""
+    def retrieve_invoice(self, invoice_id, fresh=False):
+        """Fetch invoice details from Stripe, cached briefly.
+
+        Pass fresh=True to bypass the cache (e.g. when acting on a payment
+        event); the fetched object then replaces the cached copy.
+        """
+        key = f'stripe_invoice:{invoice_id}'
+        fetch = lambda: stripe.Invoice.retrieve(invoice_id, expand=['payment_intent', 'payment_intent.charges'])
         try:
-            return stripe.Invoice.retrieve(invoice_id, expand=['payment_intent', 'payment_intent.charges'])
+            if fresh:
+                inv = fetch()
+                _cache_set_json(key, inv, INVOICE_CACHE_TTL)
+                return inv
+            return _cached_retrieve(key, stripe.Invoice, INVOICE_CACHE_TTL, fetch)
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to retrieve invoice: {str(e)}')
 
@@ -250,9 +543,12 @@ class StripeManager:
                 capabilities={
                     'card_payments': {'requested': True},
                     'transfers': {'requested': True},
-                }
+                },
+                idempotency_key=idempotency_key('create_connected_account'),
             )
             return acct
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to create connected account: {str(e)}')
 
@@ -268,9 +564,13 @@ class StripeManager:
                 account=account_id,
                 refresh_url=refresh_url,
                 return_url=return_url,
-                type='account_onboarding'
+                type='account_onboarding',
+                # Account links are single-use, so never replay an earlier one
+                idempotency_key=idempotency_key('create_account_link'),
             )
             return link
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to create account link: {str(e)}')
 
@@ -278,6 +578,8 @@ class StripeManager:
         """Retrieve a connected account's details from Stripe."""
         try:
             return stripe.Account.retrieve(account_id)
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to retrieve connected account: {str(e)}')
 
@@ -288,50 +590,174 @@ class StripeManager:
         exceptions and present appropriate messages to users.
         """
         try:
-            return stripe.Account.delete(account_id)
+            return stripe.Account.delete(
+                account_id,
+                idempotency_key=idempotency_key('delete_connected_account', account_id),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to delete connected account: {str(e)}')
 
     def extract_invoice_data(self, invoice):
         """Extract key fields from invoice object."""
+        g = _g
         return {
-            'id': invoice.get('id') if isinstance(invoice, dict) else getattr(invoice, 'id', None),
-            'subscription': invoice.get('subscription') if isinstance(invoice, dict) else getattr(invoice, 'subscription', None),
-            'amount_paid': invoice.get('amount_paid') if isinstance(invoice, dict) else getattr(invoice, 'amount_paid', None),
-            'currency': (invoice.get('currency') if isinstance(invoice, dict) else getattr(invoice, 'currency', None) or '').upper(),
-            'payment_intent': invoice.get('payment_intent') if isinstance(invoice, dict) else getattr(invoice, 'payment_intent', None),
+            'id': g(invoice, 'id'),
+            'subscription': g(invoice, 'subscription'),
+            'amount_paid': g(invoice, 'amount_paid'),
+            'currency': (g(invoice, 'currency') or '').upper(),
+            'payment_intent': g(invoice, 'payment_intent'),
         }
 
     # ==================== Payment Intent Operations ====================
 
     def retrieve_payment_intent(self, payment_intent_id):
-        """Fetch payment intent details from Stripe."""
+        """Fetch payment intent details from Stripe, cached briefly."""
         try:
-            return stripe.PaymentIntent.retrieve(payment_intent_id, expand=['charges'])
+            return _cached_retrieve(
+                f'stripe_pi:{payment_intent_id}', stripe.PaymentIntent, PAYMENT_INTENT_CACHE_TTL,
+                lambda: stripe.PaymentIntent.retrieve(payment_intent_id, expand=['charges']),
+            )
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f'Failed to retrieve payment intent: {str(e)}')
 
     def extract_payment_intent_data(self, payment_intent):
         """Extract key fields from payment intent object."""
+        g = _g
         data = {
-            'id': payment_intent.get('id') if isinstance(payment_intent, dict) else getattr(payment_intent, 'id', None),
-            'status': payment_intent.get('status') if isinstance(payment_intent, dict) else getattr(payment_intent, 'status', None),
+            'id': g(payment_intent, 'id'),
+            'status': g(payment_intent, 'status'),
             'charges': [],
         }
 
         # Extract charge IDs
         try:
-            if isinstance(payment_intent, dict):
-                charges = payment_intent.get('charges', {}).get('data', [])
-            else:
-                charges = getattr(payment_intent.charges, 'data', []) if hasattr(payment_intent, 'charges') else []
-
+            charges = g(g(payment_intent, 'charges'), 'data')
             if charges:
-                data['charges'] = [
-                    c.get('id') if isinstance(c, dict) else getattr(c, 'id', None)
-                    for c in charges
-                ]
+                data['charges'] = [g(c, 'id') for c in charges]
+            else:
+                # Newer API versions expose only the most recent charge
+                latest = g(payment_intent, 'latest_charge')
+                latest = g(latest, 'id') if isinstance(latest, dict) else latest
+                if latest:
+                    data['charges'] = [latest]
         except Exception:
             pass
 
         return data
+
+    # ==================== Local Persistence ====================
+
+    def persist_payments(self, rows):
+        """Bulk-insert unsaved SubscriptionPayment instances in one transaction.
+
+        Used by backfills so that N payments cost N/PAYMENT_BULK_BATCH_SIZE
+        INSERTs instead of one round trip each. Returns the number of rows.
+        """
+        from billing.models import SubscriptionPayment
+
+        if not rows:
+            return 0
+        with transaction.atomic():
+            SubscriptionPayment.objects.bulk_create(rows, batch_size=PAYMENT_BULK_BATCH_SIZE, ignore_conflicts=True)
+        return len(rows)
+
+
+# Shared instance for views, tasks and commands; StripeManager keeps no state
+stripe_manager = StripeManager()
+
+
+class AsyncStripeManager:
+    """Async counterpart of StripeManager for fetching independent resources concurrently.
+
+    Each instance owns an async HTTP client bound to the running event loop,
+    so create one per request and close it with ``async with``::
+
+        async with AsyncStripeManager() as mgr:
+            name, acct = await asyncio.gather(mgr.get_account_info(), mgr.retrieve_account(acct_id))
+    """
+
+    def __init__(self):
+        self._http_client = stripe.HTTPXClient(timeout=STRIPE_REQUEST_TIMEOUT)
+        self._client = stripe.StripeClient(
+            getattr(settings, 'STRIPE_SECRET_KEY', None) or '',
+            http_client=self._http_client,
+            max_network_retries=STRIPE_MAX_NETWORK_RETRIES,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._http_client.close_async()
+
+    async def get_account_info(self):
+        """Retrieve the platform account's display name (None on failure), cached for an hour."""
+        try:
+            name = await cache.aget(ACCOUNT_INFO_CACHE_KEY)
+        except Exception:
+            name = None
+        if name is not None:
+            return name
+
+        try:
+            name = _account_display_name(await self._client.accounts.retrieve_current_async())
+        except Exception:
+            return None
+        if name:
+            try:
+                await cache.aset(ACCOUNT_INFO_CACHE_KEY, name, ACCOUNT_INFO_CACHE_TTL)
+            except Exception:
+                pass
+        return name
+
+    async def retrieve_account(self, account_id):
+        """Retrieve a connected account's details from Stripe."""
+        try:
+            return await self._client.accounts.retrieve_async(account_id)
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            raise Exception(f'Failed to retrieve connected account: {str(e)}')
+
+    async def list_payment_methods(self, customer_id):
+        """List all card payment methods for a customer ([] on failure)."""
+        try:
+            pm_list = await self._client.payment_methods.list_async(
+                params={'customer': customer_id, 'type': 'card', 'limit': 100}
+            )
+            return [_pm_to_dict(m) async for m in pm_list.auto_paging_iter()]
+        except Exception:
+            return []
+
+    async def get_price(self, price_id):
+        """Fetch price details (with expanded product) from Stripe."""
+        try:
+            return await self._client.prices.retrieve_async(price_id, params={'expand': ['product']})
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            raise Exception(f'Failed to fetch price {price_id}: {str(e)}')
+
+    async def retrieve_invoice(self, invoice_id):
+        """Fetch invoice details (with payment intent and charges expanded) from Stripe."""
+        try:
+            return await self._client.invoices.retrieve_async(
+                invoice_id, params={'expand': ['payment_intent', 'payment_intent.charges']}
+            )
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            raise Exception(f'Failed to retrieve invoice: {str(e)}')
+
+    async def retrieve_subscription(self, subscription_id):
+        """Fetch subscription details from Stripe."""
+        try:
+            return await self._client.subscriptions.retrieve_async(subscription_id)
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            raise Exception(f'Failed to retrieve subscription: {str(e)}')
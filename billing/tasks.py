@@ -0,0 +1,535 @@
+"""
+Celery tasks for Stripe work that should not run inside a request.
+
+Views enqueue the Stripe round trips (e.g. subscription creation) and the
+webhook endpoint enqueues its event handlers so responses return
+immediately.
+The management commands shard work by id range (invoice PDFs) or by Stripe
+list page (subscriptions) and enqueue these tasks so several workers can
+process them in parallel.
+"""
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import stripe
+from asgiref.sync import async_to_sync
+from celery import shared_task
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from billing.models import ProcessedStripeEvent, SubscriptionPlan, UserSubscription, SubscriptionPayment
+from billing.stripe_utils import RETRYABLE_ERRORS, AsyncStripeManager, get_product_name, stripe_manager
+
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+# Stripe amounts are integer cents; multiply by this instead of dividing per price
+CENT = Decimal('0.01')
+
+# Expand the latest invoice's payment_intent and the price object on items.
+# Avoid expanding deeper than this (stripe limits expansion depth).
+SUBSCRIPTION_LIST_EXPAND = ['data.latest_invoice.payment_intent', 'data.items.data.price']
+
+# Stripe stops redelivering an event after three days, so older claims can go
+PROCESSED_EVENT_RETENTION = timedelta(days=3)
+
+
+def _to_dt(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromtimestamp(int(value), tz=timezone.utc)
+    except Exception:
+        return None
+
+
+@contextmanager
+def claim_event(event_id):
+    """Yield True if this worker should handle the Stripe event, False if it already ran.
+
+    The claim row is inserted in the same transaction as the handler's writes,
+    so a failed attempt rolls it back and the retry handles the event again.
+    """
+    with transaction.atomic():
+        first = True
+        if event_id:
+            try:
+                with transaction.atomic():
+                    ProcessedStripeEvent.objects.create(event_id=event_id)
+            except IntegrityError:
+                logger.debug('Stripe event %s already processed, skipping', event_id)
+                first = False
+        yield first
+
+
+# ==================== Request / Webhook Offloading ====================
+
+def _first_payment_failure(sub):
+    """Return why an incomplete subscription's first charge did not go through, or ''."""
+    if sub.get('status') != 'incomplete':
+        return ''
+    invoice = sub.get('latest_invoice')
+    pi = invoice.get('payment_intent') if isinstance(invoice, dict) else None
+    if isinstance(pi, dict):
+        if pi.get('status') == 'requires_action':
+            return 'Your bank asked for authentication of the first payment, which was not completed.'
+        message = (pi.get('last_payment_error') or {}).get('message')
+        if message:
+            return message[:255]
+    return 'The first payment did not go through.'
+
+
+def _fail_subscription_request(usub, reason):
+    usub.status = 'failed'
+    usub.failure_reason = reason[:255]
+    usub.save(update_fields=['status', 'failure_reason', 'updated_at'])
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def create_subscription_task(self, subscription_pk, customer_id, price_id, payment_method_id):
+    """Create the Stripe subscription for a pending local record.
+
+    The view creates the record (status 'incomplete') before enqueuing; this
+    fills in the Stripe id, or marks it 'failed' with a reason the dashboard
+    shows. Detailed status, payments and period dates are populated by webhooks.
+    """
+    usub = UserSubscription.objects.select_related(None).filter(pk=subscription_pk).first()
+    if not usub:
+        return None
+    try:
+        # The task id is stable across retries, so a retry after a timeout that
+        # did reach Stripe replays the original subscription instead of a duplicate
+        sub = stripe_manager.create_subscription(customer_id, price_id, payment_method_id, request_token=self.request.id)
+    except RETRYABLE_ERRORS:
+        if self.request.retries >= self.max_retries:
+            _fail_subscription_request(usub, 'Stripe could not be reached. Please try again.')
+        raise
+    except Exception as e:
+        # Card declines and invalid prices will not succeed on retry
+        logger.warning('Subscription creation failed for user %s: %s', usub.user_id, e)
+        # create_subscription wraps the Stripe error; prefer its customer-facing message
+        _fail_subscription_request(usub, getattr(e.__context__, 'user_message', None) or str(e))
+        return None
+
+    sub_id = sub.get('id')
+    reason = _first_payment_failure(sub)
+    with transaction.atomic():
+        # The customer.subscription.created webhook may have recorded it first
+        recorded = UserSubscription.objects.filter(stripe_subscription_id=sub_id).exclude(pk=usub.pk)
+        if not recorded.update(failure_reason=reason):
+            usub.stripe_subscription_id = sub_id
+            usub.status = sub.get('status') or usub.status
+            usub.failure_reason = reason
+            try:
+                with transaction.atomic():
+                    usub.save(update_fields=['stripe_subscription_id', 'status', 'failure_reason', 'updated_at'])
+            except IntegrityError:
+                # ...or recorded it between the update and the save
+                recorded.update(failure_reason=reason)
+                usub.delete()
+        else:
+            usub.delete()
+    logger.info('Subscription %s created for user %s', sub_id, usub.user_id)
+    return sub_id
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def handle_subscription_event_task(self, data, event_type, event_id=None):
+    """Apply a customer.subscription.* webhook payload to the local subscription."""
+    # billing.views imports this module, so pull the handlers in lazily
+    from billing.views import handle_subscription_created_or_updated, handle_subscription_deleted
+
+    with claim_event(event_id) as first:
+        if not first:
+            return
+        if event_type == 'customer.subscription.deleted':
+            handle_subscription_deleted(data)
+        else:
+            handle_subscription_created_or_updated(data)
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def handle_invoice_created_task(self, data, event_id=None):
+    """Record the pending payment for an invoice.created webhook payload."""
+    from billing.views import handle_invoice_created
+
+    with claim_event(event_id) as first:
+        if first:
+            handle_invoice_created(data)
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def handle_price_or_product_task(self, data, event_type):
+    """Drop cached Stripe price/product/plan data after a price.updated or product.updated webhook."""
+    from billing.views import handle_price_or_product_updated
+
+    handle_price_or_product_updated(data, event_type)
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def handle_connect_invoice_task(self, data, event_type, account_id, event_id=None):
+    """Update the local ConnectedAccountInvoice for a Connect invoice webhook."""
+    from billing.views import handle_connect_invoice_payment_event
+
+    with claim_event(event_id) as first:
+        if first:
+            handle_connect_invoice_payment_event(data, event_type, account_id)
+
+
+async def _fetch_invoice_and_subscription(invoice_id, subscription_id):
+    async with AsyncStripeManager() as mgr:
+        return await asyncio.gather(mgr.retrieve_invoice(invoice_id), mgr.retrieve_subscription(subscription_id))
+
+
+def _period_subscription(sub_id):
+    return UserSubscription.objects.select_related(None).only(
+        'id', 'status', 'current_period_start', 'current_period_end',
+    ).filter(stripe_subscription_id=sub_id).first()
+
+
+def _apply_subscription_periods(usub, sub):
+    """Copy a Stripe subscription's period dates and status onto `usub`; True if anything changed."""
+    data = stripe_manager.extract_subscription_data(sub)
+    changed = []
+    for field in ('current_period_start', 'current_period_end', 'status'):
+        if data[field] and data[field] != getattr(usub, field):
+            setattr(usub, field, data[field])
+            changed.append(field)
+    if changed:
+        usub.save(update_fields=changed + ['updated_at'])
+        logger.info('Updated subscription %s period: cps=%s, cpe=%s, status=%s',
+                    data['id'], usub.current_period_start, usub.current_period_end, usub.status)
+    return bool(changed)
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def sync_invoice_task(self, invoice_id, event_type, event_id=None, subscription_id=None):
+    """Fetch the invoice from Stripe and record its payment event locally.
+
+    When the webhook names the subscription, it is fetched alongside the
+    invoice and its period dates are applied here instead of in a separate
+    refresh_subscription_periods_task.
+    """
+    from billing.views import handle_invoice_payment_event, prepare_invoice_payment
+
+    # Stripe calls run before the claim transaction opens; a redelivery that
+    # was already handled is skipped without fetching anything
+    if event_id and ProcessedStripeEvent.objects.filter(event_id=event_id).exists():
+        return
+    if subscription_id:
+        invoice, sub = async_to_sync(_fetch_invoice_and_subscription)(invoice_id, subscription_id)
+    else:
+        # Uncached like the gather path: a payment_succeeded can follow a
+        # payment_failed for the same invoice within the cache TTL
+        invoice, sub = stripe_manager.retrieve_invoice(invoice_id, fresh=True), None
+    pi_id, charge_id = prepare_invoice_payment(invoice, event_type)
+
+    with claim_event(event_id) as first:
+        if not first:
+            return
+        handle_invoice_payment_event(invoice, event_type, pi_id, charge_id, refresh_periods=sub is None)
+        usub = _period_subscription(subscription_id) if sub else None
+        if usub:
+            _apply_subscription_periods(usub, sub)
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def refresh_subscription_periods_task(self, sub_id):
+    """Sync a subscription's period dates and status from Stripe after a payment event."""
+    usub = _period_subscription(sub_id)
+    if not usub:
+        return False
+    return _apply_subscription_periods(usub, stripe_manager.retrieve_subscription(sub_id, fresh=True))
+
+
+@shared_task(bind=True, autoretry_for=RETRYABLE_ERRORS, retry_backoff=True, max_retries=5)
+def sync_payment_intent_task(self, payment_intent_id):
+    """Fill in the charge id on payments recorded against a payment intent."""
+    pi_data = stripe_manager.extract_payment_intent_data(stripe_manager.retrieve_payment_intent(payment_intent_id))
+    if not pi_data['charges']:
+        return 0
+    return SubscriptionPayment.objects.filter(
+        stripe_payment_intent_id=payment_intent_id,
+        stripe_charge_id__isnull=True,
+    ).update(stripe_charge_id=pi_data['charges'][0])
+
+
+# ==================== Invoice PDF Backfill ====================
+
+@shared_task(acks_late=True)
+def fill_invoice_pdfs_chunk(id_min, id_max, dry_run=False):
+    """Populate invoice_pdf_url for payments with id in [id_min, id_max).
+
+    Returns a dict of processed/updated/failed counts for the chunk.
+    """
+    qs = SubscriptionPayment.objects.select_related(None).filter(
+        id__gte=id_min,
+        id__lt=id_max,
+        stripe_invoice_id__isnull=False,
+        invoice_pdf_url__isnull=True,
+    ).order_by('id')
+
+    processed = 0
+    updated = 0
+    failed = 0
+
+    for p in qs.iterator():
+        processed += 1
+        invoice_id = p.stripe_invoice_id
+        if not invoice_id:
+            continue
+
+        try:
+            # Try to retrieve invoice via StripeManager which expands payment_intent/charges
+            full_invoice = stripe_manager.retrieve_invoice(invoice_id)
+            # full_invoice may be dict-like or object
+            if isinstance(full_invoice, dict):
+                invoice_pdf = full_invoice.get('invoice_pdf') or full_invoice.get('hosted_invoice_url')
+            else:
+                invoice_pdf = getattr(full_invoice, 'invoice_pdf', None) or getattr(full_invoice, 'hosted_invoice_url', None)
+
+            if invoice_pdf:
+                logger.info('Invoice %s: found PDF URL', invoice_id)
+                if not dry_run:
+                    p.invoice_pdf_url = invoice_pdf
+                    p.save(update_fields=['invoice_pdf_url'])
+                    updated += 1
+            else:
+                logger.info('Invoice %s: no PDF/hosted URL available', invoice_id)
+
+        except Exception as e:
+            failed += 1
+            logger.exception('Error fetching invoice %s: %s', invoice_id, e)
+
+    return {'processed': processed, 'updated': updated, 'failed': failed}
+
+
+@shared_task
+def fill_missing_invoice_pdfs():
+    """Nightly backfill of payments whose webhook carried no invoice PDF/hosted URL."""
+    call_command('fill_invoice_pdfs')
+
+
+@shared_task
+def prune_processed_stripe_events():
+    """Nightly delete of webhook event claims older than Stripe's redelivery window."""
+    deleted, _ = ProcessedStripeEvent.objects.filter(processed_at__lt=timezone.now() - PROCESSED_EVENT_RETENTION).delete()
+    logger.info('Pruned %s processed Stripe events', deleted)
+    return deleted
+
+
+# ==================== Subscription Sync ====================
+
+def sync_subscription(s, dry=False, write=logger.info, error=logger.error, payments=None):
+    """Upsert the plan, subscription and latest payment for one Stripe subscription.
+
+    `write` and `error` receive progress and failure messages so management
+    commands can route them to stdout/stderr. When a `payments` list is given,
+    new SubscriptionPayment rows are appended to it unsaved so the caller can
+    persist them in bulk (see `StripeManager.persist_payments`).
+    """
+    try:
+        # get customer and map to local user
+        cust_id = None
+        if isinstance(s, dict):
+            cust_id = s.get('customer')
+        else:
+            cust_id = getattr(s, 'customer', None)
+
+        user = None
+        if cust_id:
+            user = User.objects.filter(stripe_customer_id=cust_id).first()
+
+        # determine price id
+        price_id = None
+        price_obj = None
+        try:
+            items = s['items']['data'] if isinstance(s, dict) else getattr(s.items, 'data', None)
+            if items and len(items) > 0:
+                price_obj = items[0].get('price') if isinstance(items[0], dict) else getattr(items[0].price, None)
+                if isinstance(price_obj, dict):
+                    price_id = price_obj.get('id')
+                else:
+                    price_id = getattr(price_obj, 'id', None)
+        except Exception:
+            price_id = None
+
+        # ensure local SubscriptionPlan exists
+        plan_obj = None
+        if price_id:
+            try:
+                # compute price decimal
+                unit_amount = None
+                if isinstance(price_obj, dict):
+                    unit_amount = price_obj.get('unit_amount') or price_obj.get('unit_amount_decimal')
+                else:
+                    unit_amount = getattr(price_obj, 'unit_amount', None) or getattr(price_obj, 'unit_amount_decimal', None)
+
+                try:
+                    price_decimal = (Decimal(int(unit_amount)) * CENT) if unit_amount is not None else Decimal('0.00')
+                except Exception:
+                    # if it's decimal string
+                    price_decimal = Decimal(str(unit_amount))
+
+                prod_name = None
+                # price_obj.product may be a string id or an expanded dict.
+                prod = None
+                if isinstance(price_obj, dict):
+                    prod = price_obj.get('product')
+                else:
+                    prod = getattr(price_obj, 'product', None)
+
+                # If product is an expanded dict, take its name.
+                if isinstance(prod, dict):
+                    prod_name = prod.get('name')
+                else:
+                    # If it's a string id, look up the (cached) product name; empty
+                    # names fall back to the price id below.
+                    prod_name = get_product_name(prod)
+
+                recurring = price_obj.get('recurring') if isinstance(price_obj, dict) else getattr(price_obj, 'recurring', None)
+                interval = (recurring or {}).get('interval', 'month')
+
+                sp_defaults = {'name': prod_name or price_id, 'price': price_decimal, 'interval': interval, 'active': True}
+                if dry:
+                    write(f'[DRY] Would update_or_create plan {price_id} -> {sp_defaults}')
+                else:
+                    plan_obj, _ = SubscriptionPlan.objects.update_or_create(stripe_price_id=price_id, defaults=sp_defaults)
+            except Exception as e:
+                error(f'Failed to sync plan {price_id}: {e}')
+
+        # upsert UserSubscription
+        try:
+            sub_id = s['id'] if isinstance(s, dict) else getattr(s, 'id', None)
+            status = s.get('status') if isinstance(s, dict) else getattr(s, 'status', None)
+            cps = s.get('current_period_start') if isinstance(s, dict) else getattr(s, 'current_period_start', None)
+            cpe = s.get('current_period_end') if isinstance(s, dict) else getattr(s, 'current_period_end', None)
+
+            cps_dt = _to_dt(cps)
+            cpe_dt = _to_dt(cpe)
+
+            if dry:
+                write(f'[DRY] Would upsert subscription {sub_id} for user {user} plan {plan_obj}')
+            else:
+                usub, created = UserSubscription.objects.update_or_create(
+                    stripe_subscription_id=sub_id,
+                    defaults={
+                        'user': user,
+                        'plan': plan_obj,
+                        'status': status or 'active',
+                        'current_period_start': cps_dt,
+                        'current_period_end': cpe_dt,
+                    }
+                )
+        except Exception as e:
+            error(f'Failed to upsert subscription {sub_id}: {e}')
+
+        # Payment: inspect latest_invoice/payment_intent
+        try:
+            invoice = None
+            raw_invoice = s.get('latest_invoice') if isinstance(s, dict) else getattr(s, 'latest_invoice', None)
+            if raw_invoice:
+                if isinstance(raw_invoice, str):
+                    invoice = stripe.Invoice.retrieve(raw_invoice, expand=['payment_intent', 'payment_intent.charges'])
+                elif isinstance(raw_invoice, dict):
+                    if not raw_invoice.get('payment_intent') and raw_invoice.get('id'):
+                        invoice = stripe.Invoice.retrieve(raw_invoice.get('id'), expand=['payment_intent', 'payment_intent.charges'])
+                    else:
+                        invoice = raw_invoice
+                else:
+                    invoice = raw_invoice
+
+            if invoice:
+                invoice_id = invoice.get('id') if isinstance(invoice, dict) else getattr(invoice, 'id', None)
+                amount_paid = invoice.get('amount_paid') if isinstance(invoice, dict) else getattr(invoice, 'amount_paid', None)
+                currency = (invoice.get('currency') if isinstance(invoice, dict) else getattr(invoice, 'currency', None) or '').upper()
+                raw_pi = invoice.get('payment_intent') if isinstance(invoice, dict) else getattr(invoice, 'payment_intent', None)
+                payment_intent = None
+                if raw_pi:
+                    if isinstance(raw_pi, str):
+                        payment_intent = stripe.PaymentIntent.retrieve(raw_pi, expand=['charges'])
+                    else:
+                        payment_intent = raw_pi
+
+                charge_id = None
+                pi_status = ''
+                if payment_intent:
+                    charges = None
+                    if hasattr(payment_intent, 'charges'):
+                        charges = getattr(payment_intent.charges, 'data', None)
+                    elif isinstance(payment_intent, dict):
+                        charges = payment_intent.get('charges', {}).get('data')
+                    if charges:
+                        first = charges[0]
+                        charge_id = getattr(first, 'id', None) if not isinstance(first, dict) else first.get('id')
+                        pi_status = getattr(payment_intent, 'status', None) if not isinstance(payment_intent, dict) else payment_intent.get('status')
+
+                # avoid duplicates: check by payment_intent id or charge id
+                existing = None
+                pi_id = (getattr(payment_intent, 'id', None) if payment_intent else None) or (payment_intent.get('id') if isinstance(payment_intent, dict) else None)
+                if pi_id:
+                    existing = SubscriptionPayment.objects.filter(stripe_payment_intent_id=pi_id).values_list('id', flat=True).first()
+                if not existing and charge_id:
+                    existing = SubscriptionPayment.objects.filter(stripe_charge_id=charge_id).values_list('id', flat=True).first()
+                if not existing and invoice_id:
+                    existing = SubscriptionPayment.objects.filter(stripe_invoice_id=invoice_id).values_list('id', flat=True).first()
+
+                # Only insert unseen payments so re-running a page (e.g. a retried task) is a no-op
+                if not existing:
+                    try:
+                        amt = (Decimal(int(amount_paid)) * CENT) if amount_paid else Decimal('0.00')
+                    except Exception:
+                        amt = Decimal('0.00')
+                    if dry:
+                        write(f'[DRY] Would create payment record for subscription {sub_id}: amt={amt} {currency} invoice={invoice_id} pi={pi_id} charge={charge_id}')
+                    else:
+                        payment = SubscriptionPayment(
+                            subscription=UserSubscription.objects.select_related(None).only('id').filter(stripe_subscription_id=sub_id).first(),
+                            user=user,
+                            amount=amt,
+                            currency=(currency or '').upper(),
+                            stripe_invoice_id=invoice_id,
+                            stripe_payment_intent_id=pi_id,
+                            stripe_charge_id=charge_id,
+                            status=pi_status or ''
+                        )
+                        if payments is not None:
+                            payments.append(payment)
+                        else:
+                            payment.save()
+        except Exception as e:
+            error(f'Failed to sync payment for subscription {sub_id}: {e}')
+
+    except Exception as e:
+        error(f'Error processing subscription record: {e}')
+
+
+@shared_task(acks_late=True)
+def sync_stripe_subscriptions_page(starting_after=None, limit=100, dry_run=False):
+    """Sync one page of Stripe subscriptions and enqueue the next page.
+
+    The next page is enqueued before the current one is processed so that
+    pages are synced concurrently across workers.
+    """
+    page = stripe.Subscription.list(
+        limit=limit,
+        starting_after=starting_after,
+        expand=SUBSCRIPTION_LIST_EXPAND,
+    )
+    subs = page.data
+    if page.has_more and subs:
+        sync_stripe_subscriptions_page.delay(subs[-1].id, limit, dry_run)
+
+    payments = []
+    for s in subs:
+        sync_subscription(s, dry=dry_run, payments=payments)
+    stripe_manager.persist_payments(payments)
+
+    return len(subs)
@@ -0,0 +1,305 @@
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+
+import stripe
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from billing import tasks, views
+from billing.models import ConnectedAccountInvoice, ProcessedStripeEvent, SubscriptionPayment, SubscriptionPlan, User, UserSubscription
+
+
+SECRET = 'whsec_test'
+
+
+def sign(payload, secret=SECRET, timestamp=None):
+    """Build a Stripe-Signature header for `payload` the way Stripe does."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    mac = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256)
+    return f't={timestamp},v1={mac.hexdigest()}'
+
+
+class ParseSignatureHeaderTests(SimpleTestCase):
+
+    def test_timestamp_and_every_v1(self):
+        self.assertEqual(views._parse_signature_header('t=123,v1=abc,v0=old,v1=def'), (123, ['abc', 'def']))
+
+    def test_spaces_after_commas(self):
+        self.assertEqual(views._parse_signature_header('t=12, v1=a'), (12, ['a']))
+
+    def test_malformed(self):
+        for header in (None, '', 'garbage', 't=abc,v1=x'):
+            with self.subTest(header=header):
+                self.assertEqual(views._parse_signature_header(header)[0], None)
+
+
+@mock.patch.object(views, '_WEBHOOK_SECRETS', (('Platform', SECRET.encode()),))
+class StripeWebhookSignatureTests(SimpleTestCase):
+
+    def post(self, payload, header):
+        request = RequestFactory().post(
+            '/stripe/webhook', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=header,
+        )
+        return async_to_sync(views.stripe_webhook)(request)
+
+    def payload(self):
+        # Unrouted type, so a verified event is accepted without side effects
+        return json.dumps({'id': f'evt_{time.time_ns()}', 'type': 'test.ping', 'data': {'object': {}}}).encode()
+
+    def test_valid_signature(self):
+        payload = self.payload()
+        self.assertEqual(self.post(payload, sign(payload)).status_code, 200)
+
+    def test_wrong_secret(self):
+        payload = self.payload()
+        self.assertEqual(self.post(payload, sign(payload, secret='whsec_other')).status_code, 403)
+
+    def test_tampered_body(self):
+        payload = self.payload()
+        self.assertEqual(self.post(payload.replace(b'ping', b'pong'), sign(payload)).status_code, 403)
+
+    def test_expired_timestamp(self):
+        payload = self.payload()
+        old = int(time.time()) - views.WEBHOOK_TOLERANCE - 60
+        self.assertEqual(self.post(payload, sign(payload, timestamp=old)).status_code, 403)
+
+    def test_multiple_v1_values(self):
+        payload = self.payload()
+        header = sign(payload)
+        timestamp, valid = header.split(',')
+        self.assertEqual(self.post(payload, f'{timestamp},v1={"0" * 64},{valid}').status_code, 200)
+
+    def test_malformed_header(self):
+        payload = self.payload()
+        for header in ('', 'garbage', f'v1={"0" * 64}', f't=soon,v1={"0" * 64}'):
+            with self.subTest(header=header):
+                self.assertEqual(self.post(payload, header).status_code, 403)
+
+    def test_non_ascii_signature(self):
+        payload = self.payload()
+        self.assertEqual(self.post(payload, f't={int(time.time())},v1=éé').status_code, 403)
+
+    def test_event_without_type_releases_claim(self):
+        event_id = f'evt_{time.time_ns()}'
+        payload = json.dumps({'id': event_id, 'data': {'object': {}}}).encode()
+        self.assertEqual(self.post(payload, sign(payload)).status_code, 400)
+        # A later, well-formed delivery of the same id is still routed
+        payload = json.dumps({'id': event_id, 'type': 'invoice.created', 'data': {'object': {'id': 'in_1'}}}).encode()
+        with mock.patch.object(views.handle_invoice_created_task, 'delay') as delay:
+            self.assertEqual(self.post(payload, sign(payload)).status_code, 200)
+        delay.assert_called_once()
+
+    def test_null_data_is_accepted(self):
+        payload = json.dumps({'id': f'evt_{time.time_ns()}', 'type': 'test.ping', 'data': None}).encode()
+        self.assertEqual(self.post(payload, sign(payload)).status_code, 200)
+
+    def test_enqueue_failure_releases_claim(self):
+        payload = json.dumps({'id': f'evt_{time.time_ns()}', 'type': 'invoice.created', 'data': {'object': {'id': 'in_1'}}}).encode()
+        with mock.patch.object(views.handle_invoice_created_task, 'delay', side_effect=OSError('broker down')):
+            self.assertEqual(self.post(payload, sign(payload)).status_code, 500)
+        with mock.patch.object(views.handle_invoice_created_task, 'delay') as delay:
+            self.assertEqual(self.post(payload, sign(payload)).status_code, 200)
+        delay.assert_called_once()
+
+    def test_duplicate_delivery_is_enqueued_once(self):
+        payload = json.dumps({'id': f'evt_{time.time_ns()}', 'type': 'invoice.created', 'data': {'object': {'id': 'in_1'}}}).encode()
+        with mock.patch.object(views.handle_invoice_created_task, 'delay') as delay:
+            for _ in range(2):
+                self.assertEqual(self.post(payload, sign(payload)).status_code, 200)
+        delay.assert_called_once()
+
+
+@mock.patch.object(views, '_role_group_ids', {})
+class RoleGroupIdTests(TransactionTestCase):
+
+    def test_id_from_rolled_back_transaction_is_not_cached(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            views.role_group_id('athlete')
+            raise RuntimeError
+        self.assertFalse(Group.objects.filter(name='athlete').exists())
+        self.assertEqual(views.role_group_id('athlete'), Group.objects.get(name='athlete').id)
+
+    def test_cached_outside_transaction(self):
+        gid = views.role_group_id('coach')
+        with self.assertNumQueries(0):
+            self.assertEqual(views.role_group_id('coach'), gid)
+
+
+def declined(*args, **kwargs):
+    # Mirrors StripeManager.create_subscription, which wraps non-retryable errors
+    try:
+        raise stripe.error.CardError('Your card was declined.', None, 'card_declined')
+    except stripe.error.CardError as e:
+        raise Exception(f'Failed to create subscription: {e}')
+
+
+class CreateSubscriptionTaskTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='athlete', stripe_customer_id='cus_1')
+        plan = SubscriptionPlan.objects.create(name='Athlete Monthly', price=10, stripe_price_id='price_1')
+        self.usub = UserSubscription.objects.create(user=user, plan=plan, status='incomplete')
+
+    def run_task(self, **stripe_result):
+        with mock.patch.object(tasks.stripe_manager, 'create_subscription', **stripe_result):
+            tasks.create_subscription_task.apply(args=(self.usub.pk, 'cus_1', 'price_1', 'pm_1'))
+        self.usub.refresh_from_db()
+
+    def test_success_fills_in_pending_record(self):
+        self.run_task(return_value={'id': 'sub_1', 'status': 'active'})
+        self.assertEqual((self.usub.stripe_subscription_id, self.usub.status, self.usub.failure_reason), ('sub_1', 'active', ''))
+
+    def test_card_decline_is_recorded(self):
+        self.run_task(side_effect=declined)
+        self.assertEqual((self.usub.status, self.usub.failure_reason), ('failed', 'Your card was declined.'))
+
+    def test_incomplete_first_payment_is_recorded(self):
+        pi = {'status': 'requires_action'}
+        self.run_task(return_value={'id': 'sub_1', 'status': 'incomplete', 'latest_invoice': {'payment_intent': pi}})
+        self.assertEqual(self.usub.status, 'incomplete')
+        self.assertIn('authentication', self.usub.failure_reason)
+
+    def test_webhook_recorded_it_first(self):
+        UserSubscription.objects.create(user_id=self.usub.user_id, plan_id=self.usub.plan_id, stripe_subscription_id='sub_1', status='active')
+        with mock.patch.object(tasks.stripe_manager, 'create_subscription', return_value={'id': 'sub_1', 'status': 'active'}):
+            tasks.create_subscription_task.apply(args=(self.usub.pk, 'cus_1', 'price_1', 'pm_1'))
+        self.assertEqual(list(UserSubscription.objects.values_list('stripe_subscription_id', flat=True)), ['sub_1'])
+
+
+class PruneProcessedStripeEventsTests(TestCase):
+
+    def test_deletes_only_events_past_retention(self):
+        now = timezone.now()
+        ProcessedStripeEvent.objects.create(event_id='evt_old', processed_at=now - tasks.PROCESSED_EVENT_RETENTION - timedelta(hours=1))
+        ProcessedStripeEvent.objects.create(event_id='evt_new', processed_at=now)
+        self.assertEqual(tasks.prune_processed_stripe_events(), 1)
+        self.assertEqual(list(ProcessedStripeEvent.objects.values_list('event_id', flat=True)), ['evt_new'])
+
+
+class InvoicePaymentEventTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='athlete', stripe_customer_id='cus_1')
+        plan = SubscriptionPlan.objects.create(name='Athlete Monthly', price=10, stripe_price_id='price_1')
+        UserSubscription.objects.create(user=user, plan=plan, stripe_subscription_id='sub_1', status='trialing')
+        self.invoice = {'id': 'in_1', 'subscription': 'sub_1', 'amount_due': 1000, 'currency': 'usd', 'status': 'open'}
+
+    def test_succeeded_fills_ids_on_pending_payment(self):
+        views.handle_invoice_created(self.invoice)
+        paid = dict(self.invoice, status='paid', invoice_pdf='https://example.com/in_1.pdf')
+        with mock.patch.object(views.cache, 'add', return_value=False):
+            views.handle_invoice_payment_event(paid, 'invoice.payment_succeeded', 'pi_1', 'ch_1')
+        payment = SubscriptionPayment.objects.get()
+        self.assertEqual(
+            (payment.status, payment.stripe_payment_intent_id, payment.stripe_charge_id, payment.invoice_pdf_url),
+            ('succeeded', 'pi_1', 'ch_1', 'https://example.com/in_1.pdf'),
+        )
+
+
+class ClaimEventTests(TestCase):
+
+    def test_failed_handler_releases_claim(self):
+        with self.assertRaises(RuntimeError), tasks.claim_event('evt_1') as first:
+            self.assertTrue(first)
+            raise RuntimeError
+        self.assertFalse(ProcessedStripeEvent.objects.exists())
+        with tasks.claim_event('evt_1') as first:
+            self.assertTrue(first)
+        with tasks.claim_event('evt_1') as first:
+            self.assertFalse(first)
+
+    def test_processed_event_skips_invoice_fetch(self):
+        ProcessedStripeEvent.objects.create(event_id='evt_1')
+        with mock.patch.object(tasks.stripe_manager, 'retrieve_invoice') as retrieve:
+            tasks.sync_invoice_task.apply(args=('in_1', 'invoice.payment_succeeded', 'evt_1'))
+        retrieve.assert_not_called()
+
+
+class FirstDeliveryTests(SimpleTestCase):
+
+    def test_claims_once(self):
+        event_id = f'evt_{time.time_ns()}'
+        self.assertTrue(async_to_sync(views._first_delivery)(event_id))
+        self.assertFalse(async_to_sync(views._first_delivery)(event_id))
+        async_to_sync(views._forget_delivery)(event_id)
+        self.assertTrue(async_to_sync(views._first_delivery)(event_id))
+
+    def test_cache_error_lets_event_through(self):
+        with mock.patch.object(views.cache, 'aadd', side_effect=ConnectionError):
+            self.assertTrue(async_to_sync(views._first_delivery)('evt_1'))
+
+
+class SubscriptionEventTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='athlete', stripe_customer_id='cus_1')
+        self.plan = SubscriptionPlan.objects.create(name='Athlete Monthly', price=10, stripe_price_id='price_1')
+        self.event = {
+            'id': 'sub_1', 'customer': 'cus_1', 'status': 'active', 'cancel_at_period_end': False,
+            'items': {'data': [{'price': {'id': 'price_1'}}]},
+        }
+
+    def test_created_then_updated_keeps_one_row(self):
+        views.handle_subscription_created_or_updated(self.event)
+        views.handle_subscription_created_or_updated(dict(self.event, status='past_due'))
+        self.assertEqual(list(UserSubscription.objects.values_list('status', 'plan_id')), [('past_due', self.plan.id)])
+        self.assertTrue(self.user.groups.filter(name='athlete').exists())
+
+    def test_concurrent_insert_falls_back_to_update(self):
+        # Another worker inserted the row after our update matched nothing
+        UserSubscription.objects.create(user=self.user, plan=self.plan, stripe_subscription_id='sub_1', status='incomplete')
+        update = QuerySet.update
+        calls = []
+
+        def first_update_misses(qs, **kwargs):
+            calls.append(kwargs)
+            return 0 if len(calls) == 1 else update(qs, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=first_update_misses):
+            views.handle_subscription_created_or_updated(self.event)
+        self.assertEqual(list(UserSubscription.objects.values_list('stripe_subscription_id', 'status')), [('sub_1', 'active')])
+
+
+class PlanNameToRoleTests(SimpleTestCase):
+
+    def test_ranking(self):
+        cases = {
+            'Athlete Monthly': 'athlete',
+            'Host + Athlete bundle': 'athlete',
+            'Guest host pass': 'host',
+            'Free guest': 'guest',
+            'Pro': 'free',
+            '': 'free',
+        }
+        for name, role in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(views.plan_name_to_role(name), role)
+
+
+class ConnectInvoiceEventTests(TestCase):
+
+    def paid(self, stored_pdf):
+        ConnectedAccountInvoice.objects.create(connected_account='acct_1', stripe_invoice_id='in_1', invoice_pdf_url=stored_pdf)
+        views.handle_connect_invoice_payment_event(
+            {'id': 'in_1', 'status': 'paid', 'paid': True, 'invoice_pdf': 'https://example.com/new.pdf'}, 'invoice.paid', 'acct_1',
+        )
+        return ConnectedAccountInvoice.objects.get()
+
+    def test_fills_missing_pdf(self):
+        invoice = self.paid(None)
+        self.assertEqual((invoice.status, invoice.invoice_pdf_url), ('paid', 'https://example.com/new.pdf'))
+        self.assertIsNotNone(invoice.paid_at)
+
+    def test_keeps_stored_pdf(self):
+        self.assertEqual(self.paid('https://example.com/old.pdf').invoice_pdf_url, 'https://example.com/old.pdf')
@@ -1,5 +1,9 @@
+import functools
+import hashlib
+import hmac
 import json
-import stripe
+import re
+import time
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
@@ -8,16 +12,34 @@ from datetime import datetime
 from decimal import Decimal
 import logging
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from billing.models import UserSubscription, SubscriptionPlan, SubscriptionPayment, ConnectedAccountInvoice
-from billing.stripe_utils import StripeManager
+from billing.stripe_utils import invalidate_account_info, invalidate_price, invalidate_product, invalidate_subscription, stripe_manager
+from billing.tasks import handle_connect_invoice_task, handle_invoice_created_task, handle_price_or_product_task, handle_subscription_event_task, refresh_subscription_periods_task, sync_invoice_task, sync_payment_intent_task
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, URLField, Value, When
+
+try:
+    # Parses bytes directly and is several times faster on large event bodies
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
 
+# (substring, role) pairs; when a name contains several, the earlier pair wins
+_ROLE_TOKENS = (('athlete', 'athlete'), ('host', 'host'), ('guest', 'guest'), ('free', 'free'))
+_ROLE_RE = re.compile('|'.join(re.escape(token) for token, _ in _ROLE_TOKENS))
+_ROLE_RANK = {token: (rank, role) for rank, (token, role) in enumerate(_ROLE_TOKENS)}
+
+
+@functools.lru_cache(maxsize=512)
 def plan_name_to_role(plan_name: str) -> str:
     """Map a given plan name to one of the role candidates (lower-case).
 
@@ -26,35 +48,134 @@ def plan_name_to_role(plan_name: str) -> str:
     """
     if not plan_name:
         return 'free'
-    n = plan_name.strip().lower()
-    if 'athlete' in n:
-        return 'athlete'
-    if 'host' in n:
-        return 'host'
-    if 'guest' in n:
-        return 'guest'
-    if 'free' in n:
+    # One regex scan finds every token; most names have at most one
+    matches = _ROLE_RE.findall(plan_name.lower())
+    if not matches:
         return 'free'
-    return 'free'
+    return min(_ROLE_RANK[m] for m in matches)[1]
+
+
+class _LazyJSON:
+    """Log argument that only serializes `obj` to JSON if the record is emitted.
+
+    Keeps large Stripe payload dumps off the hot path when DEBUG is disabled.
+    """
+    __slots__ = ('obj', 'indent', 'limit')
+
+    def __init__(self, obj, indent=None, limit=None):
+        self.obj = obj
+        self.indent = indent
+        self.limit = limit
+
+    def __str__(self):
+        text = json.dumps(self.obj, default=str, indent=self.indent)
+        return text[:self.limit] if self.limit else text
+
+
+# Groups a user can hold through a subscription; 'free' is the fallback
+ROLE_CANDIDATES = ['free', 'athlete', 'host', 'guest']
+
+# Stripe retries undelivered events for up to three days; a day covers the bursts
+WEBHOOK_EVENT_DEDUP_TTL = 60 * 60 * 24
+
+# Payment events for one subscription within this window share one Stripe refresh
+SUBSCRIPTION_REFRESH_DEDUP_TTL = 60
+
+# How much of a webhook body to scan for the top-level "account" of Connect events
+WEBHOOK_ACCOUNT_PEEK_BYTES = 512
+
+# Reject signed webhooks older than this many seconds (Stripe's own default)
+WEBHOOK_TOLERANCE = 300
+
+# Local plans are looked up by Stripe price id on every subscription webhook
+# but change rarely
+PLAN_CACHE_TTL = 60 * 60
+
+
+def _plan_cache_key(price_id):
+    return f'plan:price:{price_id}'
+
+
+def get_plan_for_price(price_id):
+    """Return the local plan's {'id', 'name'} for a Stripe price, cached for an hour.
+
+    Unknown prices are not cached so that a plan created later is picked up.
+    """
+    key = _plan_cache_key(price_id)
+    try:
+        plan = cache.get(key)
+    except Exception:
+        plan = None
+    if plan is None:
+        plan = SubscriptionPlan.objects.filter(stripe_price_id=price_id).values('id', 'name').first()
+        if plan is not None:
+            try:
+                cache.set(key, plan, PLAN_CACHE_TTL)
+            except Exception:
+                pass
+    return plan
+
+
+def invalidate_plans(price_ids):
+    """Drop cached plan lookups for the given Stripe price ids."""
+    try:
+        cache.delete_many([_plan_cache_key(pid) for pid in price_ids if pid])
+    except Exception:
+        pass
+
+
+_role_group_ids = {}
+
+
+def role_group_id(role):
+    """Return the id of the Group for a role, creating it on first use.
+
+    Cached for the life of the process; role groups are never renamed or deleted.
+    Ids read inside a transaction are not cached, since a group created there
+    disappears again if the transaction rolls back.
+    """
+    gid = _role_group_ids.get(role)
+    if gid is None:
+        gid = Group.objects.get_or_create(name=role)[0].id
+        if not transaction.get_connection().in_atomic_block:
+            _role_group_ids[role] = gid
+    return gid
+
+
+def add_user_groups(user, group_ids):
+    """Add `user` to the groups in one INSERT, skipping memberships that already exist.
+
+    Writes the auth through table directly, so m2m_changed signals are not sent.
+    """
+    Membership = User.groups.through
+    Membership.objects.bulk_create(
+        [Membership(user_id=user.pk, group_id=gid) for gid in group_ids],
+        ignore_conflicts=True,
+    )
+
+
+def remove_user_groups(user, group_ids):
+    """Remove `user` from the groups in one DELETE; returns how many were removed."""
+    return User.groups.through.objects.filter(user_id=user.pk, group_id__in=group_ids).delete()[0]
 
 
 # ==================== Event Handler Functions ====================
 
 def handle_subscription_created_or_updated(data):
     """Handle customer.subscription.created and customer.subscription.updated events."""
-    stripe_mgr = StripeManager()
     sub = data
     sub_id = sub.get('id')
     customer = sub.get('customer')
     status = sub.get('status')
     cancel_at_period_end = sub.get('cancel_at_period_end')
     canceled_at = sub.get('canceled_at')
+    invalidate_subscription(sub_id)
 
     logger.debug('=== SUBSCRIPTION DATA ===')
     logger.debug('Subscription ID: %s', sub_id)
     logger.debug('Customer: %s', customer)
     logger.debug('Status: %s', status)
-    logger.debug('Full subscription object: %s', json.dumps(sub, default=str, indent=2)[:2000])  # First 2000 chars
+    logger.debug('Full subscription object: %s', _LazyJSON(sub, indent=2, limit=2000))  # First 2000 chars
     logger.debug('=== END SUBSCRIPTION DATA ===')
 
     logger.debug('Processing subscription %s: status=%s', sub_id, status)
@@ -65,7 +186,7 @@ def handle_subscription_created_or_updated(data):
         logger.warning('Could not find user for customer %s', customer)
 
     # Attempt to resolve plan from items
-    plan_obj = None
+    plan = None
     try:
         items = sub.get('items', {}).get('data') if isinstance(sub.get('items'), dict) else sub.get('items')
         if items and isinstance(items, list) and len(items) > 0:
@@ -73,76 +194,63 @@ def handle_subscription_created_or_updated(data):
             price = first.get('price') if isinstance(first, dict) else None
             price_id = price.get('id') if isinstance(price, dict) else (getattr(price, 'id', None) if price else None)
             if price_id:
-                plan_obj = SubscriptionPlan.objects.filter(stripe_price_id=price_id).first()
-                if plan_obj:
-                    logger.debug('Found plan %s for price %s', plan_obj.id, price_id)
+                plan = get_plan_for_price(price_id)
+                if plan:
+                    logger.debug('Found plan %s for price %s', plan['id'], price_id)
     except Exception as e:
         logger.exception('Error resolving plan from subscription items')
-        plan_obj = None
+        plan = None
 
     # Extract period dates from webhook data using StripeManager
-    extracted_data = stripe_mgr.extract_subscription_data(sub)
+    extracted_data = stripe_manager.extract_subscription_data(sub)
     cps = extracted_data['current_period_start']
     cpe = extracted_data['current_period_end']
 
     # Update or create local subscription
-    usub, created = UserSubscription.objects.update_or_create(
-        stripe_subscription_id=sub_id,
-        defaults={
-            'user': user,
-            'plan': plan_obj,
-            'status': status or '',
-            'current_period_start': cps,
-            'current_period_end': cpe,
-            'cancel_at_period_end': bool(cancel_at_period_end) if cancel_at_period_end is not None else False,
-            'cancelled_at': (stripe_mgr._to_datetime(canceled_at) if canceled_at else None),
-        }
-    )
-    logger.info('Subscription %s %s: user=%s, plan=%s, status=%s, cps=%s, cpe=%s', sub_id, 'created' if created else 'updated', user, plan_obj, status, cps, cpe)
+    defaults = {
+        'user': user,
+        'plan_id': plan['id'] if plan else None,
+        'status': status or '',
+        'current_period_start': cps,
+        'current_period_end': cpe,
+        'cancel_at_period_end': bool(cancel_at_period_end) if cancel_at_period_end is not None else False,
+        'cancelled_at': (stripe_manager._to_datetime(canceled_at) if canceled_at else None),
+    }
+    # Most events are for existing subscriptions: update in place without loading the row
+    # (update() skips auto_now, so set updated_at explicitly)
+    existing = UserSubscription.objects.filter(stripe_subscription_id=sub_id)
+    created = not existing.update(updated_at=timezone.now(), **defaults)
+    if created:
+        try:
+            with transaction.atomic():
+                UserSubscription.objects.create(stripe_subscription_id=sub_id, **defaults)
+        except IntegrityError:
+            # Another worker (or create_subscription_task) inserted it since the update
+            if not existing.update(updated_at=timezone.now(), **defaults):
+                raise
+            created = False
+    logger.info('Subscription %s %s: user=%s, plan=%s, status=%s, cps=%s, cpe=%s', sub_id, 'created' if created else 'updated', user, plan['name'] if plan else None, status, cps, cpe)
     # Assign role/group to the user based on the plan name, but respect scheduled cancellations
-    def plan_name_to_role(plan_name: str) -> str:
-        """Map a given plan name to one of the role candidates (lower-case).
-
-        Uses substring matching so names like 'Athlete Monthly' -> 'athlete'.
-        Any unknown or empty name returns 'free'.
-        """
-        if not plan_name:
-            return 'free'
-        n = plan_name.strip().lower()
-        if 'athlete' in n:
-            return 'athlete'
-        if 'host' in n:
-            return 'host'
-        if 'guest' in n:
-            return 'guest'
-        if 'free' in n:
-            return 'free'
-        return 'free'
-
     try:
         if user:
             # If subscription is canceled (finalized), remove the role corresponding to this subscription
-            if (status == 'canceled') or (usub.cancelled_at is not None):
+            if (status == 'canceled') or (defaults['cancelled_at'] is not None):
                 try:
-                    role = plan_name_to_role(usub.plan.name if usub.plan else None)
-                    g = Group.objects.filter(name=role).first()
-                    if g and user.groups.filter(pk=g.pk).exists():
-                        user.groups.remove(g)
+                    role = plan_name_to_role(plan['name'] if plan else None)
+                    if remove_user_groups(user, [role_group_id(role)]):
                         logger.info('Removed role group "%s" from user %s due to cancellation', role, user)
                 except Exception:
                     logger.exception('Error removing role group for user %s on cancellation', user)
             else:
                 # If cancellation is scheduled at period end, keep existing groups until deletion
-                if usub.cancel_at_period_end:
+                if defaults['cancel_at_period_end']:
                     logger.debug('Subscription %s is scheduled to cancel at period end; preserving user groups until end date', sub_id)
                 else:
                     # Add role for this subscription's plan (allow multiple groups per user)
                     try:
-                        desired = plan_name_to_role(plan_obj.name if plan_obj else None)
-                        g, _ = Group.objects.get_or_create(name=desired)
-                        if not user.groups.filter(pk=g.pk).exists():
-                            user.groups.add(g)
-                            logger.info('Added role group "%s" to user %s', desired, user)
+                        desired = plan_name_to_role(plan['name'] if plan else None)
+                        add_user_groups(user, [role_group_id(desired)])
+                        logger.info('Ensured role group "%s" for user %s', desired, user)
                     except Exception:
                         logger.exception('Error adding role group for user %s', user)
     except Exception:
@@ -154,10 +262,11 @@ def handle_subscription_deleted(data):
     sub = data
     sub_id = sub.get('id')
     canceled_at = sub.get('canceled_at')
+    invalidate_subscription(sub_id)
 
     logger.debug('Processing subscription deletion: %s', sub_id)
 
-    usub = UserSubscription.objects.filter(stripe_subscription_id=sub_id).first()
+    usub = UserSubscription.objects.select_related('user', 'plan').filter(stripe_subscription_id=sub_id).first()
     if usub:
         usub.status = 'canceled'
         try:
@@ -167,28 +276,22 @@ def handle_subscription_deleted(data):
                 usub.cancelled_at = timezone.now()
         except Exception:
             usub.cancelled_at = timezone.now()
-        usub.save()
+        usub.save(update_fields=['status', 'cancelled_at', 'updated_at'])
         logger.info('Subscription %s marked as canceled', sub_id)
         # When subscription deleted, remove only the role corresponding to this plan
         try:
             if usub.user:
                 role = plan_name_to_role(usub.plan.name if usub.plan else None)
-                g = Group.objects.filter(name=role).first()
-                if g and usub.user.groups.filter(pk=g.pk).exists():
-                    usub.user.groups.remove(g)
+                # One query for the user's current role groups; the rest is set logic
+                current = set(usub.user.groups.filter(name__in=ROLE_CANDIDATES).values_list('name', flat=True))
+                if role in current:
+                    remove_user_groups(usub.user, [role_group_id(role)])
+                    current.discard(role)
                     logger.info('Removed role group "%s" from user %s after subscription deletion', role, usub.user)
 
                 # If user now has no role groups among candidates, add 'free'
-                role_candidates = ['free', 'athlete', 'host', 'guest']
-                has_role = False
-                for r in role_candidates:
-                    gg = Group.objects.filter(name=r).first()
-                    if gg and usub.user.groups.filter(pk=gg.pk).exists():
-                        has_role = True
-                        break
-                if not has_role:
-                    free_group, _ = Group.objects.get_or_create(name='free')
-                    usub.user.groups.add(free_group)
+                if not current:
+                    add_user_groups(usub.user, [role_group_id('free')])
                     logger.info('Assigned user %s to role group "free" because no other role groups present', usub.user)
         except Exception:
             logger.exception('Error updating role groups after subscription deletion for user %s', usub.user)
@@ -196,10 +299,9 @@ def handle_subscription_deleted(data):
         logger.warning('Could not find subscription for deletion: %s', sub_id)
 
 
+@transaction.atomic
 def handle_invoice_created(data):
     """Handle invoice.created event - create pending SubscriptionPayment record."""
-    stripe_mgr = StripeManager()
-    
     inv = data
     invoice_id = inv.get('id')
     sub_id = inv.get('subscription')
@@ -208,8 +310,10 @@ def handle_invoice_created(data):
     
     logger.debug('Invoice created: id=%s, subscription=%s, amount_due=%s', invoice_id, sub_id, amount_due)
     
-    # Find the subscription and user
-    usub = UserSubscription.objects.filter(stripe_subscription_id=sub_id).first() if sub_id else None
+    # Find the subscription and user; only the ids are needed for the payment row.
+    # The row lock serialises invoice events for the same subscription, so a
+    # concurrent payment event waits here instead of inserting a duplicate payment.
+    usub = UserSubscription.objects.select_related(None).only('id', 'user_id').select_for_update().filter(stripe_subscription_id=sub_id).first() if sub_id else None
     if not usub:
         logger.warning('Could not find subscription for invoice %s (sub_id=%s)', invoice_id, sub_id)
         return
@@ -220,27 +324,17 @@ def handle_invoice_created(data):
         return
     
     try:
-        # Convert amount to Decimal
-        from decimal import Decimal
-        amt = Decimal(str(int(amount_due) / 100.0)) if amount_due else Decimal('0.00')
+        # Convert integer cents to Decimal exactly (no float round trip)
+        amt = Decimal(int(amount_due)).scaleb(-2) if amount_due else Decimal('0.00')
         
-        # Create payment record with 'pending' status
-        # Attempt to determine authoritative invoice PDF/hosted URL
-        invoice_pdf = None
-        try:
-            # Prefer invoice field if present in webhook payload
-            invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
-            if not invoice_pdf:
-                # Fetch full invoice from Stripe (safe fallback)
-                logger.debug('Fetching full invoice from Stripe to obtain PDF/hosted URL for invoice %s', invoice_id)
-                full_invoice = stripe.Invoice.retrieve(invoice_id)
-                invoice_pdf = (full_invoice.get('invoice_pdf') if isinstance(full_invoice, dict) else getattr(full_invoice, 'invoice_pdf', None)) or (full_invoice.get('hosted_invoice_url') if isinstance(full_invoice, dict) else getattr(full_invoice, 'hosted_invoice_url', None))
-        except Exception:
-            invoice_pdf = None
+        # Create payment record with 'pending' status. Use the invoice PDF/hosted
+        # URL from the payload; draft invoices have neither yet, and the nightly
+        # fill_missing_invoice_pdfs task backfills any that stay missing.
+        invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
 
         payment = SubscriptionPayment.objects.create(
             subscription=usub,
-            user=usub.user,
+            user_id=usub.user_id,
             amount=amt,
             currency=currency,
             stripe_invoice_id=invoice_id,
@@ -249,14 +343,26 @@ def handle_invoice_created(data):
         )
         logger.info('Created pending payment for invoice %s: amount=%s, subscription=%s', invoice_id, amt, sub_id)
     except Exception as e:
-        logger.exception('ERROR creating SubscriptionPayment for invoice %s: %s', invoice_id, str(e))
+        logger.exception('ERROR creating SubscriptionPayment for invoice %s: %s', invoice_id, e)
 
 
-def handle_invoice_payment_event(data, event_type):
-    """Handle invoice.payment_succeeded and invoice.payment_failed events."""
-    stripe_mgr = StripeManager()
-    
-    inv = data
+def _line_amount(line):
+    """Return an invoice line's amount in cents: its price's unit_amount_decimal, else its amount."""
+    unit_amount_decimal = ((line.get('pricing') or {}).get('price_details') or {}).get('unit_amount_decimal')
+    if unit_amount_decimal:
+        try:
+            return int(Decimal(unit_amount_decimal))
+        except (ArithmeticError, ValueError):
+            pass
+    return line.get('amount')
+
+
+def prepare_invoice_payment(inv, event_type):
+    """Make the Stripe calls an invoice payment event needs; returns (payment_intent_id, charge_id).
+
+    Kept apart from handle_invoice_payment_event so callers can run it before
+    opening a transaction, and a slow API response never holds a row lock.
+    """
     invoice_id = inv.get('id')
     status = inv.get('status')
     
@@ -264,11 +370,61 @@ def handle_invoice_payment_event(data, event_type):
     if status == 'draft':
         try:
             logger.debug('Invoice %s is in draft status, attempting to finalize...', invoice_id)
-            stripe_mgr.finalize_invoice(invoice_id)
+            stripe_manager.finalize_invoice(invoice_id)
             logger.info('Successfully finalized draft invoice %s', invoice_id)
         except Exception as e:
-            logger.warning('Could not finalize invoice %s: %s', invoice_id, str(e))
-    
+            logger.warning('Could not finalize invoice %s: %s', invoice_id, e)
+
+    pi_id = None
+    charge_id = None
+    payment_intent = inv.get('payment_intent')
+
+    # Extract payment_intent id from webhook data (can be string ID or object)
+    logger.debug('Extracting payment_intent from invoice data...')
+    if isinstance(payment_intent, dict):
+        pi_id = payment_intent.get('id')
+        logger.debug('Payment intent is dict, extracted id: %s', pi_id)
+    elif isinstance(payment_intent, str):
+        pi_id = payment_intent
+        logger.debug('Payment intent is string id: %s', pi_id)
+    else:
+        logger.debug('Payment intent is unexpected type: %s', type(payment_intent))
+
+    # The invoice is retrieved with its payment intent and charges expanded,
+    # so only fall back to a separate fetch when the intent came as a bare id
+    if pi_id and event_type == 'invoice.payment_succeeded':
+        try:
+            if isinstance(payment_intent, dict):
+                pi_obj = payment_intent
+            else:
+                logger.debug('Fetching payment intent details from Stripe: %s', pi_id)
+                pi_obj = stripe_manager.retrieve_payment_intent(pi_id)
+            logger.debug('Full PaymentIntent object: %s', _LazyJSON(pi_obj))
+            pi_data = stripe_manager.extract_payment_intent_data(pi_obj)
+            
+            logger.debug('Extracted PaymentIntent data: %s', _LazyJSON(pi_data))
+            
+            # Extract charge ID if available
+            if pi_data['charges'] and len(pi_data['charges']) > 0:
+                charge_id = pi_data['charges'][0]
+                logger.debug('Extracted charge ID %s from payment intent %s', charge_id, pi_id)
+            else:
+                logger.debug('No charges found in payment intent %s', pi_id)
+        except Exception as e:
+            logger.exception('Could not fetch payment intent %s: %s', pi_id, e)
+
+    return pi_id, charge_id
+
+
+@transaction.atomic
+def handle_invoice_payment_event(data, event_type, pi_id=None, charge_id=None, refresh_periods=True):
+    """Handle invoice.payment_succeeded and invoice.payment_failed events.
+
+    `pi_id` and `charge_id` come from prepare_invoice_payment.
+    """
+    inv = data
+    invoice_id = inv.get('id')
+
     # Try to get subscription from top level first, then from nested structure
     sub_id = inv.get('subscription')
     if not sub_id:
@@ -293,8 +449,8 @@ def handle_invoice_payment_event(data, event_type):
     # Use amount_due (the actual charge amount), fallback to amount_paid
     amount = amount_due if amount_due is not None else amount_paid
     
-    # Find subscription first (needed to use plan price)
-    usub = UserSubscription.objects.filter(stripe_subscription_id=sub_id).first() if sub_id else None
+    # Find subscription first (needed to use plan price); lock it like handle_invoice_created
+    usub = UserSubscription.objects.select_related(None).select_related('plan').only('id', 'user_id', 'status', 'plan__price').select_for_update(of=('self',)).filter(stripe_subscription_id=sub_id).first() if sub_id else None
     if not usub:
         logger.warning('Could not find subscription for invoice %s (sub_id=%s)', invoice_id, sub_id)
     
@@ -313,28 +469,11 @@ def handle_invoice_payment_event(data, event_type):
             lines = inv.get('lines', {}).get('data') if isinstance(inv.get('lines'), dict) else inv.get('lines')
             logger.debug('Amount is still 0, attempting to extract from line items, lines type: %s, count: %s', type(lines), len(lines) if lines else 0)
             if lines and isinstance(lines, list):
-                # Try to get unit_amount_decimal or amount from price details
-                for line in lines:
-                    if isinstance(line, dict):
-                        pricing = line.get('pricing', {})
-                        price_details = pricing.get('price_details', {})
-                        # Get unit_amount_decimal from price_details
-                        unit_amount_decimal = price_details.get('unit_amount_decimal')
-                        if unit_amount_decimal:
-                            try:
-                                amount = int(Decimal(unit_amount_decimal))
-                                logger.debug('Extracted unit_amount_decimal from price_details: %s', amount)
-                                break
-                            except:
-                                pass
-                        # Fallback: get amount from line item
-                        line_amount = line.get('amount', 0)
-                        if line_amount:
-                            amount = line_amount
-                            logger.debug('Extracted amount from line item: %s', amount)
-                            break
+                # First line with a usable amount wins
+                amount = next(filter(None, (_line_amount(line) for line in lines if isinstance(line, dict))), amount)
+                logger.debug('Extracted amount from line items: %s', amount)
         except Exception as e:
-            logger.exception('Error extracting amount from line items: %s', str(e))
+            logger.exception('Error extracting amount from line items: %s', e)
     
     currency = (inv.get('currency') or '').upper()
     payment_intent = inv.get('payment_intent')
@@ -345,137 +484,74 @@ def handle_invoice_payment_event(data, event_type):
     logger.debug('Subscription (from invoice): %s', sub_id)
     logger.debug('Amount Paid: %s', amount_paid)
     logger.debug('Payment Intent (raw): %s', payment_intent)
-    logger.debug('Full invoice object (first 3000 chars): %s', json.dumps(inv, default=str, indent=2)[:3000])
+    logger.debug('Full invoice object (first 3000 chars): %s', _LazyJSON(inv, indent=2, limit=3000))
     logger.debug('=== END INVOICE DATA ===')
 
     logger.debug('Processing invoice %s: sub_id=%s, amount=%s, status=%s', invoice_id, sub_id, amount_paid, event_type)
 
-    # If subscription is not in webhook data, try to fetch full invoice from Stripe
-    if not sub_id:
+    # Refresh the subscription's period dates and status from Stripe off the
+    # webhook path; a burst of payment events for one subscription collapses
+    # into a single refresh
+    if refresh_periods and usub and sub_id:
         try:
-            logger.debug('Subscription ID missing from invoice webhook, fetching from Stripe: %s', invoice_id)
-            full_invoice = stripe.Invoice.retrieve(invoice_id)
-            sub_id = full_invoice.get('subscription') if isinstance(full_invoice, dict) else getattr(full_invoice, 'subscription', None)
-            logger.debug('Retrieved subscription %s from Stripe for invoice %s', sub_id, invoice_id)
-        except Exception as e:
-            logger.warning('Could not fetch invoice from Stripe: %s', str(e))
-
-    # Re-lookup usub if we fetched sub_id from Stripe
-    if not usub and sub_id:
-        usub = UserSubscription.objects.filter(stripe_subscription_id=sub_id).first()
-        if not usub:
-            logger.warning('Could not find subscription for invoice %s (sub_id=%s)', invoice_id, sub_id)
-
-    # Update usersubscription current period start and end from Stripe (like refresh-subscriptions API)
-    if usub and sub_id:
-        try:
-            logger.debug('Fetching subscription details from Stripe for %s', sub_id)
-            remote = stripe_mgr.retrieve_subscription(sub_id)
-            data_extracted = stripe_mgr.extract_subscription_data(remote)
-            
-            updated = False
-            if data_extracted['current_period_start'] and data_extracted['current_period_start'] != usub.current_period_start:
-                usub.current_period_start = data_extracted['current_period_start']
-                updated = True
-            if data_extracted['current_period_end'] and data_extracted['current_period_end'] != usub.current_period_end:
-                usub.current_period_end = data_extracted['current_period_end']
-                updated = True
-            if data_extracted['status'] and data_extracted['status'] != usub.status:
-                usub.status = data_extracted['status']
-                updated = True
-            
-            if updated:
-                usub.save()
-                logger.info('Updated subscription %s period: cps=%s, cpe=%s, status=%s', 
-                           sub_id, data_extracted['current_period_start'], data_extracted['current_period_end'], data_extracted['status'])
-        except Exception as e:
-            logger.warning('Could not update subscription periods for %s: %s', sub_id, str(e))
+            first = cache.add(f'refresh:{sub_id}', 1, SUBSCRIPTION_REFRESH_DEDUP_TTL)
+        except Exception:
+            first = True
+        if first:
+            # Enqueue only once the payment rows are committed; a rolled-back
+            # transaction leaves nothing to refresh
+            transaction.on_commit(lambda: refresh_subscription_periods_task.delay(sub_id))
 
     # Record payment if we have a subscription (amount can be 0 for prorations or credits)
     logger.debug('Payment creation condition check: usub=%s, payment_intent=%s, amount=%s', bool(usub), bool(payment_intent), amount)
     
     # Check if payment already exists
-    existing_payment = SubscriptionPayment.objects.filter(stripe_invoice_id=invoice_id).first()
+    existing_payment = SubscriptionPayment.objects.select_related(None).only('id', 'status', 'invoice_pdf_url').filter(stripe_invoice_id=invoice_id).first()
     
     if event_type == 'invoice.payment_succeeded':
         if existing_payment:
             # Update existing payment to succeeded status
             logger.debug('Payment exists for invoice %s, updating status to succeeded', invoice_id)
-            # Attempt to update invoice PDF/hosted URL if present in the invoice payload
-            try:
-                invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
-                if not invoice_pdf:
-                    # fetch from stripe if missing
-                    try:
-                        full_invoice = stripe.Invoice.retrieve(invoice_id)
-                        invoice_pdf = (full_invoice.get('invoice_pdf') if isinstance(full_invoice, dict) else getattr(full_invoice, 'invoice_pdf', None)) or (full_invoice.get('hosted_invoice_url') if isinstance(full_invoice, dict) else getattr(full_invoice, 'hosted_invoice_url', None))
-                    except Exception:
-                        invoice_pdf = None
-                if invoice_pdf:
-                    existing_payment.invoice_pdf_url = invoice_pdf
-            except Exception:
-                pass
+            # Update invoice PDF/hosted URL if present in the invoice payload
+            invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
+            if invoice_pdf:
+                existing_payment.invoice_pdf_url = invoice_pdf
 
             existing_payment.status = 'succeeded'
-            existing_payment.save()
+            update_fields = ['status', 'invoice_pdf_url']
+            # invoice.created recorded the row before any charge existed; fill in the
+            # ids now so sync_payment_intent_task and charge lookups can find it
+            if pi_id:
+                existing_payment.stripe_payment_intent_id = pi_id
+                update_fields.append('stripe_payment_intent_id')
+            if charge_id:
+                existing_payment.stripe_charge_id = charge_id
+                update_fields.append('stripe_charge_id')
+            existing_payment.save(update_fields=update_fields)
             logger.info('Updated payment status to succeeded for invoice %s', invoice_id)
             
             # Activate the subscription if it's in trialing status
             if usub and usub.status == 'trialing':
                 usub.status = 'active'
-                usub.save()
+                usub.save(update_fields=['status', 'updated_at'])
                 logger.info('Activated subscription %s after payment succeeded', sub_id)
         else:
             # Create new payment record with succeeded status if we have a subscription
             logger.debug('Payment not previously recorded, creating new SubscriptionPayment with succeeded status...')
             if usub:  # Only need subscription, amount can be 0
                 try:
-                    amt = (int(amount) / 100.0) if amount is not None else 0
-                    # Convert to Decimal for DecimalField
-                    amt = Decimal(str(amt))
+                    # Convert integer cents to Decimal exactly for DecimalField
+                    amt = Decimal(int(amount)).scaleb(-2) if amount is not None else Decimal('0.00')
                 except Exception as e:
-                    logger.exception('Error converting amount to Decimal: %s', str(e))
+                    logger.exception('Error converting amount to Decimal: %s', e)
                     amt = Decimal('0.00')
                 
-                pi_id = None
-                charge_id = None
-
-                # Extract payment_intent id from webhook data (can be string ID or object)
-                logger.debug('Extracting payment_intent from invoice data...')
-                if isinstance(payment_intent, dict):
-                    pi_id = payment_intent.get('id')
-                    logger.debug('Payment intent is dict, extracted id: %s', pi_id)
-                elif isinstance(payment_intent, str):
-                    pi_id = payment_intent
-                    logger.debug('Payment intent is string id: %s', pi_id)
-                else:
-                    logger.debug('Payment intent is unexpected type: %s', type(payment_intent))
-
-                # If we have a payment_intent ID, fetch full details to extract charge ID
-                if pi_id:
-                    try:
-                        logger.debug('Fetching payment intent details from Stripe: %s', pi_id)
-                        pi_obj = stripe_mgr.retrieve_payment_intent(pi_id)
-                        logger.debug('Full PaymentIntent object: %s', json.dumps(pi_obj if isinstance(pi_obj, dict) else {'id': getattr(pi_obj, 'id', None), 'charges': str(getattr(pi_obj, 'charges', None))}, default=str))
-                        pi_data = stripe_mgr.extract_payment_intent_data(pi_obj)
-                        
-                        logger.debug('Extracted PaymentIntent data: %s', json.dumps(pi_data, default=str))
-                        
-                        # Extract charge ID if available
-                        if pi_data['charges'] and len(pi_data['charges']) > 0:
-                            charge_id = pi_data['charges'][0]
-                            logger.debug('Extracted charge ID %s from payment intent %s', charge_id, pi_id)
-                        else:
-                            logger.debug('No charges found in payment intent %s', pi_id)
-                    except Exception as e:
-                        logger.exception('Could not fetch payment intent %s: %s', pi_id, str(e))
-
                 logger.debug('Creating payment with: pi_id=%s, charge_id=%s, amount=%s', pi_id, charge_id, amt)
                 
                 try:
                     payment = SubscriptionPayment.objects.create(
                         subscription=usub,
-                        user=usub.user if usub else None,
+                        user_id=usub.user_id if usub else None,
                         amount=amt,
                         currency=currency,
                         stripe_invoice_id=invoice_id,
@@ -490,10 +566,10 @@ def handle_invoice_payment_event(data, event_type):
                     # Activate the subscription if it's in trialing status
                     if usub and usub.status == 'trialing':
                         usub.status = 'active'
-                        usub.save()
+                        usub.save(update_fields=['status', 'updated_at'])
                         logger.info('Activated subscription %s after payment succeeded', sub_id)
                 except Exception as e:
-                    logger.exception('ERROR creating SubscriptionPayment for invoice %s: %s', invoice_id, str(e))
+                    logger.exception('ERROR creating SubscriptionPayment for invoice %s: %s', invoice_id, e)
             else:
                 logger.debug('No subscription found, skipping payment record creation')
     
@@ -501,37 +577,27 @@ def handle_invoice_payment_event(data, event_type):
         if existing_payment:
             # Update existing payment to failed status and update invoice PDF url if available
             logger.debug('Payment exists for invoice %s, updating status to failed', invoice_id)
-            try:
-                invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
-                if not invoice_pdf:
-                    try:
-                        full_invoice = stripe.Invoice.retrieve(invoice_id)
-                        invoice_pdf = (full_invoice.get('invoice_pdf') if isinstance(full_invoice, dict) else getattr(full_invoice, 'invoice_pdf', None)) or (full_invoice.get('hosted_invoice_url') if isinstance(full_invoice, dict) else getattr(full_invoice, 'hosted_invoice_url', None))
-                    except Exception:
-                        invoice_pdf = None
-                if invoice_pdf:
-                    existing_payment.invoice_pdf_url = invoice_pdf
-            except Exception:
-                pass
+            invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
+            if invoice_pdf:
+                existing_payment.invoice_pdf_url = invoice_pdf
 
             existing_payment.status = 'failed'
-            existing_payment.save()
+            existing_payment.save(update_fields=['status', 'invoice_pdf_url'])
             logger.info('Updated payment status to failed for invoice %s', invoice_id)
         else:
             # Create new payment record with failed status
             logger.debug('Payment not previously recorded, creating new SubscriptionPayment with failed status...')
             if usub:
                 try:
-                    amt = (int(amount) / 100.0) if amount is not None else 0
-                    amt = Decimal(str(amt))
+                    amt = Decimal(int(amount)).scaleb(-2) if amount is not None else Decimal('0.00')
                 except Exception as e:
-                    logger.exception('Error converting amount to Decimal: %s', str(e))
+                    logger.exception('Error converting amount to Decimal: %s', e)
                     amt = Decimal('0.00')
 
                 try:
                     payment = SubscriptionPayment.objects.create(
                         subscription=usub,
-                        user=usub.user if usub else None,
+                        user_id=usub.user_id if usub else None,
                         amount=amt,
                         currency=currency,
                         stripe_invoice_id=invoice_id,
@@ -540,7 +606,7 @@ def handle_invoice_payment_event(data, event_type):
                     )
                     logger.info('Created failed payment for invoice %s: amount=%s, subscription=%s', invoice_id, amt, sub_id)
                 except Exception as e:
-                    logger.exception('ERROR creating failed SubscriptionPayment for invoice %s: %s', invoice_id, str(e))
+                    logger.exception('ERROR creating failed SubscriptionPayment for invoice %s: %s', invoice_id, e)
 
 
 def handle_payment_intent_succeeded(data):
@@ -548,7 +614,23 @@ def handle_payment_intent_succeeded(data):
     pi = data
     pi_id = pi.get('id')
     logger.debug('Payment intent succeeded: %s', pi_id)
-    # Could be extended to handle additional logic if needed
+    # Backfill the charge id on any payment already recorded for this intent
+    if pi_id:
+        sync_payment_intent_task.delay(pi_id)
+
+
+def handle_price_or_product_updated(data, event_type):
+    """Handle price.updated and product.updated events by dropping cached Stripe data."""
+    obj_id = data.get('id')
+    if event_type == 'price.updated':
+        invalidate_price(obj_id)
+        invalidate_plans([obj_id])
+    else:
+        # Cached prices embed the expanded product, so drop every known plan price too
+        price_ids = list(SubscriptionPlan.objects.exclude(stripe_price_id__isnull=True).values_list('stripe_price_id', flat=True))
+        invalidate_product(obj_id, price_ids)
+        invalidate_plans(price_ids)
+    logger.debug('Invalidated cached Stripe data after %s: %s', event_type, obj_id)
 
 
 def handle_connect_invoice_payment_event(data, event_type, account_id):
@@ -566,136 +648,254 @@ def handle_connect_invoice_payment_event(data, event_type, account_id):
     logger.info('Processing Connect invoice event %s for account %s: invoice=%s, status=%s, paid=%s', 
                 event_type, account_id, invoice_id, status, paid)
     
-    # Find the ConnectedAccountInvoice record
-    invoice_record = ConnectedAccountInvoice.objects.filter(
-        stripe_invoice_id=invoice_id,
-        connected_account=account_id
-    ).first()
-    
-    if not invoice_record:
-        logger.warning('No ConnectedAccountInvoice found for invoice %s on account %s', invoice_id, account_id)
-        return
-    
-    # Update invoice status based on event
+    # Work out the new values, then apply them with a single UPDATE
     if event_type == 'invoice.paid' or (event_type == 'invoice.payment_succeeded' and paid):
-        invoice_record.status = 'paid'
-        invoice_record.paid_at = timezone.now()
-        
-        # Update invoice PDF URL if available
+        changes = {'status': 'paid', 'paid_at': timezone.now()}
+        # Update invoice PDF URL if available, without overwriting one already stored
         invoice_pdf = inv.get('invoice_pdf') or inv.get('hosted_invoice_url')
-        if invoice_pdf and not invoice_record.invoice_pdf_url:
-            invoice_record.invoice_pdf_url = invoice_pdf
-        
-        invoice_record.save()
-        logger.info('Updated ConnectedAccountInvoice %s to paid status', invoice_id)
-        
+        if invoice_pdf:
+            changes['invoice_pdf_url'] = Case(
+                When(Q(invoice_pdf_url__isnull=True) | Q(invoice_pdf_url=''), then=Value(invoice_pdf)),
+                default=F('invoice_pdf_url'),
+                output_field=URLField(),
+            )
     elif event_type == 'invoice.payment_failed':
-        invoice_record.status = 'payment_failed'
-        invoice_record.save()
-        logger.info('Updated ConnectedAccountInvoice %s to payment_failed status', invoice_id)
-        
+        changes = {'status': 'payment_failed'}
     elif status == 'void':
-        invoice_record.status = 'void'
-        invoice_record.save()
-        logger.info('Updated ConnectedAccountInvoice %s to void status', invoice_id)
+        changes = {'status': 'void'}
+    else:
+        return
+
+    updated = ConnectedAccountInvoice.objects.filter(
+        stripe_invoice_id=invoice_id,
+        connected_account=account_id
+    ).update(**changes)
+
+    if not updated:
+        logger.warning('No ConnectedAccountInvoice found for invoice %s on account %s', invoice_id, account_id)
+        return
+    logger.info('Updated ConnectedAccountInvoice %s to %s status', invoice_id, changes['status'])
+
+
+# ==================== Event Routing ====================
+# Each route is called as route(data, typ, event_id, account)
+
+def _route_subscription_event(data, typ, event_id, account):
+    handle_subscription_event_task.delay(data, typ, event_id=event_id)
+
+
+def _route_invoice_created(data, typ, event_id, account):
+    handle_invoice_created_task.delay(data, event_id=event_id)
+
+
+def _route_invoice_payment(data, typ, event_id, account):
+    # Stripe round trips for invoice sync run in a worker, not the request
+    sync_invoice_task.delay(data.get('id'), typ, event_id=event_id, subscription_id=data.get('subscription'))
+
+
+def _route_payment_intent_succeeded(data, typ, event_id, account):
+    handle_payment_intent_succeeded(data)
+
+
+def _route_price_or_product_updated(data, typ, event_id, account):
+    # product.updated reads every plan's price id, so keep it off the request
+    handle_price_or_product_task.delay(data, typ)
+
+
+def _route_account_updated(data, typ, event_id, account):
+    # Platform account changed; the cached display name may be stale
+    invalidate_account_info()
+
+
+def _route_connect_invoice(data, typ, event_id, account):
+    handle_connect_invoice_task.delay(data, typ, account, event_id=event_id)
+
+
+# Event types that share a dispatcher
+SUBSCRIPTION_EVENT_TYPES = frozenset({'customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted'})
+INVOICE_PAYMENT_EVENT_TYPES = frozenset({'invoice.payment_succeeded', 'invoice.payment_failed'})
+CONNECT_INVOICE_EVENT_TYPES = frozenset({'invoice.paid', 'invoice.payment_succeeded', 'invoice.payment_failed'})
+
+_PLATFORM_ROUTES = {
+    **dict.fromkeys(SUBSCRIPTION_EVENT_TYPES, _route_subscription_event),
+    'invoice.created': _route_invoice_created,
+    **dict.fromkeys(INVOICE_PAYMENT_EVENT_TYPES, _route_invoice_payment),
+    'payment_intent.succeeded': _route_payment_intent_succeeded,
+    'price.updated': _route_price_or_product_updated,
+    'product.updated': _route_price_or_product_updated,
+    'account.updated': _route_account_updated,
+}
+
+_CONNECT_ROUTES = dict.fromkeys(CONNECT_INVOICE_EVENT_TYPES, _route_connect_invoice)
 
 
 # ==================== Main Webhook Handler ====================
 
+# (name, secret) pairs read from settings once, Connect first; secrets are
+# pre-encoded for hmac.new
+_WEBHOOK_SECRETS = tuple(
+    (name, secret.encode('utf-8'))
+    for name, secret in (
+        ('Connect', getattr(settings, 'STRIPE_CONNECT_WEBHOOK_SECRET', None)),
+        ('Platform', getattr(settings, 'STRIPE_WEBHOOK_SECRET', None)),
+    )
+    if secret
+)
+
+_SIGNATURE_ITEM_RE = re.compile(r'(?:^|,)\s*(t|v1)=([^,]+)')
+
+
+def _parse_signature_header(header):
+    """Split a Stripe-Signature header into its timestamp and v1 signatures."""
+    timestamp = None
+    signatures = []
+    for key, value in _SIGNATURE_ITEM_RE.findall(header or ''):
+        if key == 'v1':
+            signatures.append(value)
+        elif timestamp is None:
+            try:
+                timestamp = int(value)
+            except ValueError:
+                return None, []
+    return timestamp, signatures
+
+
+def _signature_matches(payload, timestamp, signatures, secret):
+    """Return True if one of the header's v1 signatures is the HMAC of `payload` under `secret` (bytes)."""
+    # Feed the prefix and body separately rather than copying the body into one signed string
+    mac = hmac.new(secret, b'%d.' % timestamp, hashlib.sha256)
+    mac.update(payload)
+    expected = mac.hexdigest().encode('ascii')
+    # Compare as bytes: compare_digest raises on non-ASCII str, and a header
+    # value must never turn a bad signature into a 500
+    return any(hmac.compare_digest(expected, sig.encode('ascii', 'replace')) for sig in signatures)
+
+
+# Matches the event id when it is the body's first key, as Stripe sends it
+_EVENT_ID_PREFIX_RE = re.compile(rb'\A\s*\{\s*"id"\s*:\s*"(evt_\w+)"')
+
+
+async def _first_delivery(event_id):
+    """Claim a Stripe event id in the cache; False if it was already accepted."""
+    try:
+        return await cache.aadd(f'stripe:evt:{event_id}', 1, WEBHOOK_EVENT_DEDUP_TTL)
+    except Exception:
+        return True
+
+
+async def _forget_delivery(event_id):
+    """Release a claimed event id so Stripe's redelivery is processed."""
+    try:
+        await cache.adelete(f'stripe:evt:{event_id}')
+    except Exception:
+        pass
+
+
 @csrf_exempt
-def stripe_webhook(request):
-    """Main webhook handler that routes events to appropriate handlers."""
-    payload = request.body
-    logger.debug('Received stripe webhook payload: %d bytes', len(payload or b''))
-    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    
-    # Get both webhook secrets
-    webhook_secret = getattr(settings, 'STRIPE_WEBHOOK_SECRET', None)
-    connect_webhook_secret = getattr(settings, 'STRIPE_CONNECT_WEBHOOK_SECRET', None)
+async def stripe_webhook(request):
+    """Main webhook handler that routes events to appropriate handlers.
 
-    event = None
+    Async so that, under ASGI, requests waiting on the cache or the broker
+    don't each hold a worker thread; verification and parsing are CPU-bound
+    and run inline.
+    """
+    payload = request.body or b''
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Received stripe webhook payload: %d bytes', len(payload))
+    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
     
-    # Try to verify with both secrets (try Connect secret first, then platform secret)
-    secrets_to_try = []
-    if connect_webhook_secret:
-        secrets_to_try.append(('Connect', connect_webhook_secret))
-    if webhook_secret:
-        secrets_to_try.append(('Platform', webhook_secret))
+    # Try to verify with both secrets, starting with the likely one so the
+    # common case costs one HMAC over the body. Connect events carry a
+    # top-level "account" near the start of the payload; a wrong guess only
+    # costs the fallback attempt.
+    secrets_to_try = _WEBHOOK_SECRETS
+    if b'"account"' not in payload[:WEBHOOK_ACCOUNT_PEEK_BYTES]:
+        secrets_to_try = secrets_to_try[::-1]
     
-    if not secrets_to_try:
-        # If no webhook secrets configured, fall back to naive parsing (not recommended for production)
-        logger.warning('No webhook secrets configured, using naive parsing')
+    # Parse the header once and check each secret with a single HMAC over
+    # the raw body; the JSON is only decoded after a signature matches.
+    # BillingConfig.ready() refuses to start without a secret when DEBUG is
+    # off, so there is no unverified path.
+    timestamp, signatures = _parse_signature_header(sig_header)
+    # One integer check before any HMAC; also rejects far-future timestamps
+    if timestamp is None or abs(int(time.time()) - timestamp) > WEBHOOK_TOLERANCE:
+        logger.error('Missing or stale timestamp in Stripe-Signature header')
+        return HttpResponseForbidden('Invalid signature')
+
+    for secret_name, secret in secrets_to_try:
+        if _signature_matches(payload, timestamp, signatures, secret):
+            logger.debug('Successfully verified webhook signature with %s secret', secret_name)
+            break
+        logger.debug('Signature verification failed with %s secret', secret_name)
+    else:
+        logger.error('Failed to verify webhook signature with any configured secret')
+        return HttpResponseForbidden('Invalid signature')
+
+    # Stripe redelivers events it isn't sure we got; skip ones already accepted.
+    # Workers also claim the id in ProcessedStripeEvent in case the cache is lost.
+    # Stripe serialises the event id first, so a redelivery is usually caught
+    # from the raw bytes before the body is parsed at all.
+    match = _EVENT_ID_PREFIX_RE.match(payload)
+    event_id = match.group(1).decode('ascii') if match else None
+    if event_id and not await _first_delivery(event_id):
+        logger.debug('Skipping already processed Stripe event %s', event_id)
+        return HttpResponse(status=200)
+
+    # Everything below runs with the event id claimed, so any failure must
+    # release it; otherwise Stripe's redelivery is acknowledged and dropped
+    typ = None
+    try:
+        # Handlers receive plain dicts; nothing downstream needs StripeObject
         try:
-            event = stripe.Event.construct_from(json.loads(payload.decode('utf-8')), stripe.api_key)
+            event = _json_loads(payload)
         except ValueError:
+            event = None
             logger.exception('Invalid payload when parsing stripe webhook')
+        # Read each top-level field once; the rest of the view uses these locals
+        get = event.get if isinstance(event, dict) else None
+        typ = get('type') if get else None
+        if not isinstance(typ, str):
+            if event_id:
+                await _forget_delivery(event_id)
             return HttpResponseBadRequest('Invalid payload')
-    else:
-        # Try each secret until one works
-        last_error = None
-        for secret_name, secret in secrets_to_try:
-            try:
-                event = stripe.Webhook.construct_event(payload, sig_header, secret)
-                logger.debug('Successfully verified webhook signature with %s secret', secret_name)
-                break
-            except stripe.error.SignatureVerificationError as e:
-                logger.debug('Signature verification failed with %s secret: %s', secret_name, str(e))
-                last_error = e
-                continue
-            except ValueError as e:
-                logger.exception('Invalid payload when parsing stripe webhook')
+        data = get('data')
+        data = (data.get('object') if isinstance(data, dict) else None) or {}
+        account = get('account')
+
+        if event_id is None:
+            if not isinstance(get('id'), str):
                 return HttpResponseBadRequest('Invalid payload')
-            except Exception as e:
-                logger.debug('Error verifying with %s secret: %s', secret_name, str(e))
-                last_error = e
-                continue
-        
-        if not event:
-            logger.error('Failed to verify webhook signature with any configured secret')
-            return HttpResponseForbidden('Invalid signature')
+            event_id = get('id')
+            if not await _first_delivery(event_id):
+                logger.debug('Skipping already processed Stripe event %s (%s)', event_id, typ)
+                return HttpResponse(status=200)
 
-    typ = event['type']
-    data = event.get('data', {}).get('object', {})
-    
-    # Check if this is a Connect event (has account field)
-    account = event.get('account')
-    is_connect_event = bool(account)
+        # Check if this is a Connect event (has account field)
+        is_connect_event = bool(account)
 
-    try:
         if is_connect_event:
-            logger.info('Stripe Connect webhook from account %s: %s', account, event.get('type'))
+            logger.info('Stripe Connect webhook from account %s: %s', account, typ)
         else:
-            logger.info('Stripe webhook: %s', event.get('type'))
+            logger.info('Stripe webhook: %s', typ)
         # logger.debug('Event data: %s', json.dumps(data, default=str))
 
-        # Handle Connect account events separately
-        if is_connect_event:
-            # Route Connect events
-            if typ in ['invoice.paid', 'invoice.payment_succeeded', 'invoice.payment_failed']:
-                handle_connect_invoice_payment_event(data, typ, account)
-            else:
-                logger.debug('Unhandled Connect event type: %s', typ)
+        # One dict lookup routes the event; handlers that touch the DB or
+        # Stripe run in a worker so Stripe gets its 200 right away
+        route = (_CONNECT_ROUTES if is_connect_event else _PLATFORM_ROUTES).get(typ)
+        if route:
+            # Enqueueing talks to the broker, so keep it off the event loop
+            await sync_to_async(route)(data, typ, event_id, account)
         else:
-            # Route platform account events (existing handlers)
-            if typ == 'customer.subscription.created' or typ == 'customer.subscription.updated':
-                handle_subscription_created_or_updated(data)
-
-            elif typ == 'customer.subscription.deleted':
-                handle_subscription_deleted(data)
-
-            elif typ == 'invoice.created':
-                handle_invoice_created(data)
-
-            elif typ == 'invoice.payment_succeeded' or typ == 'invoice.payment_failed':
-                handle_invoice_payment_event(data, typ)
+            logger.debug('Unhandled %s event type: %s', 'Connect' if is_connect_event else 'platform', typ)
 
-            elif typ == 'payment_intent.succeeded':
-                handle_payment_intent_succeeded(data)
-
-            else:
-                logger.debug('Unhandled event type: %s', typ)
-
-    except Exception:
-        logger.exception('Error handling stripe webhook event: %s', typ)
+    except Exception as e:
+        # Nothing was queued (e.g. broker unavailable); a non-2xx makes Stripe
+        # redeliver, so Stripe's retry schedule is the dead-letter path here.
+        # Failures inside handlers are retried by the Celery tasks themselves.
+        logger.error('Error enqueueing stripe webhook event %s (%s): %s: %s', event_id, typ, type(e).__name__, e,
+                     extra={'stripe_event_id': event_id, 'stripe_event_type': typ, 'error': type(e).__name__})
+        if event_id:
+            await _forget_delivery(event_id)
+        return HttpResponse(status=500)
 
     return HttpResponse(status=200)
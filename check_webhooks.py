@@ -3,75 +3,97 @@ Test script to verify webhook is receiving and processing connected account invo
 
 Run this after setting up webhooks to check if everything is working.
 """
+import sys
+
 from billing.models import ConnectedAccountInvoice
 from django.contrib.auth import get_user_model
+from django.db.models import Count, Q
 
 User = get_user_model()
 
+def _write_report(lines):
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
 def check_webhook_status():
     """Check the status of ConnectedAccountInvoices to verify webhook processing."""
     
-    print("\n" + "="*70)
-    print("CONNECTED ACCOUNT INVOICE STATUS CHECK")
-    print("="*70 + "\n")
+    # Collect the report and write it once instead of a print per line
+    out = []
+    out.append("\n" + "="*70)
+    out.append("CONNECTED ACCOUNT INVOICE STATUS CHECK")
+    out.append("="*70 + "\n")
     
     invoices = ConnectedAccountInvoice.objects.all().order_by('-created_at')
+    # One query for the total and every status count shown in the summary
+    counts = ConnectedAccountInvoice.objects.aggregate(
+        total=Count('id'),
+        paid=Count('id', filter=Q(status='paid')),
+        pending=Count('id', filter=Q(status='pending')),
+        failed=Count('id', filter=Q(status='payment_failed')),
+    )
     
-    if not invoices.exists():
-        print("❌ No invoices found in database")
-        print("\nCreate an invoice first by:")
-        print("1. Going to /accounts/invoices/")
-        print("2. Filling out the form and sending an invoice")
+    if not counts['total']:
+        out.append("❌ No invoices found in database")
+        out.append("\nCreate an invoice first by:")
+        out.append("1. Going to /accounts/invoices/")
+        out.append("2. Filling out the form and sending an invoice")
+        _write_report(out)
         return
     
-    print(f"Found {invoices.count()} invoice(s):\n")
+    out.append(f"Found {counts['total']} invoice(s):\n")
     
-    for inv in invoices:
-        print(f"Invoice ID: {inv.stripe_invoice_id or '(not created in Stripe yet)'}")
-        print(f"  Status: {inv.status}")
-        print(f"  Amount: {inv.amount} {inv.currency}")
-        print(f"  Email: {inv.customer_email}")
-        print(f"  Connected Account: {inv.connected_account}")
+    rows = invoices.values(
+        'stripe_invoice_id', 'status', 'amount', 'currency', 'customer_email',
+        'connected_account', 'paid_at', 'hosted_invoice_url', 'created_at',
+    ).iterator(chunk_size=500)
+    for inv in rows:
+        out.append(f"Invoice ID: {inv['stripe_invoice_id'] or '(not created in Stripe yet)'}")
+        out.append(f"  Status: {inv['status']}")
+        out.append(f"  Amount: {inv['amount']} {inv['currency']}")
+        out.append(f"  Email: {inv['customer_email']}")
+        out.append(f"  Connected Account: {inv['connected_account']}")
         
-        if inv.status == 'paid':
-            print(f"  ✅ Paid at: {inv.paid_at}")
-            print("  → Webhook is working! Invoice marked as paid.")
-        elif inv.status == 'pending':
-            print("  ⏳ Status: Pending payment")
-            print(f"  → Payment link: {inv.hosted_invoice_url}")
-            print("  → Pay this invoice to test webhook")
-        elif inv.status == 'payment_failed':
-            print("  ❌ Payment failed")
-            print("  → Webhook received payment failure event")
+        if inv['status'] == 'paid':
+            out.append(f"  ✅ Paid at: {inv['paid_at']}")
+            out.append("  → Webhook is working! Invoice marked as paid.")
+        elif inv['status'] == 'pending':
+            out.append("  ⏳ Status: Pending payment")
+            out.append(f"  → Payment link: {inv['hosted_invoice_url']}")
+            out.append("  → Pay this invoice to test webhook")
+        elif inv['status'] == 'payment_failed':
+            out.append("  ❌ Payment failed")
+            out.append("  → Webhook received payment failure event")
         else:
-            print(f"  ℹ️  Status: {inv.status}")
+            out.append(f"  ℹ️  Status: {inv['status']}")
         
-        print(f"  Created: {inv.created_at}")
-        print()
+        out.append(f"  Created: {inv['created_at']}")
+        out.append('')
     
     # Check for webhooks that might have been processed
-    paid_count = invoices.filter(status='paid').count()
-    pending_count = invoices.filter(status='pending').count()
-    failed_count = invoices.filter(status='payment_failed').count()
+    paid_count = counts['paid']
+    pending_count = counts['pending']
+    failed_count = counts['failed']
     
-    print("\n" + "-"*70)
-    print("SUMMARY:")
-    print(f"  Paid: {paid_count}")
-    print(f"  Pending: {pending_count}")
-    print(f"  Failed: {failed_count}")
-    print("-"*70 + "\n")
+    out.append("\n" + "-"*70)
+    out.append("SUMMARY:")
+    out.append(f"  Paid: {paid_count}")
+    out.append(f"  Pending: {pending_count}")
+    out.append(f"  Failed: {failed_count}")
+    out.append("-"*70 + "\n")
     
     if paid_count > 0:
-        print("✅ SUCCESS! You have paid invoices, which means webhooks are working!")
+        out.append("✅ SUCCESS! You have paid invoices, which means webhooks are working!")
     elif pending_count > 0:
-        print("⏳ You have pending invoices. Pay one to test webhook functionality.")
-        print("\nTo test:")
-        print("1. Copy the payment link from above")
-        print("2. Open it in a browser")
-        print("3. Use test card: 4242 4242 4242 4242")
-        print("4. Complete the payment")
-        print("5. Run this script again to see if status changed to 'paid'")
+        out.append("⏳ You have pending invoices. Pay one to test webhook functionality.")
+        out.append("\nTo test:")
+        out.append("1. Copy the payment link from above")
+        out.append("2. Open it in a browser")
+        out.append("3. Use test card: 4242 4242 4242 4242")
+        out.append("4. Complete the payment")
+        out.append("5. Run this script again to see if status changed to 'paid'")
     
+    _write_report(out)
     return invoices
 
 def check_webhook_config():
@@ -84,7 +106,7 @@ def check_webhook_config():
     from django.conf import settings
     
     # Check if webhook secret is configured
-    webhook_secret = getattr(settings, 'STRIPE_WEBHOOK_SECRET', None)
+    webhook_secret = settings.STRIPE_WEBHOOK_SECRET
     
     if webhook_secret:
         print("✅ STRIPE_WEBHOOK_SECRET is configured")
@@ -95,7 +117,7 @@ def check_webhook_config():
         print("   STRIPE_WEBHOOK_SECRET=whsec_your_secret_here")
     
     # Check Stripe API key
-    stripe_key = getattr(settings, 'STRIPE_SECRET_KEY', None)
+    stripe_key = settings.STRIPE_SECRET_KEY
     if stripe_key:
         print("✅ STRIPE_SECRET_KEY is configured")
     else:
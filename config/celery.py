@@ -0,0 +1,16 @@
+"""
+Celery application for the config project.
+
+Workers are started with ``celery -A config worker``; tasks are discovered
+from each installed app's ``tasks.py``.
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+app = Celery('config')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -1,12 +1,17 @@
+from types import MappingProxyType
+
 from django.conf import settings
 
 
+# Settings are fixed for the life of the process, so build the context once;
+# the read-only proxy keeps one render from changing it for the next
+_CONTEXT = MappingProxyType({'STRIPE_PUBLISHABLE_KEY': getattr(settings, 'STRIPE_PUBLISHABLE_KEY', '')})
+
+
 def stripe_publishable_key(request):
     """Expose STRIPE_PUBLISHABLE_KEY to templates as `STRIPE_PUBLISHABLE_KEY`.
 
     This keeps templates simple (they can reference the constant) without
     requiring every view to pass it in the context.
     """
-    return {
-        'STRIPE_PUBLISHABLE_KEY': getattr(settings, 'STRIPE_PUBLISHABLE_KEY', '')
-    }
+    return _CONTEXT
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 from decouple import config
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -99,6 +100,22 @@ else:
     }
 
 
+# Cache: use Redis when `REDIS_URL` is set (e.g. in Docker). Otherwise fall back to local memory.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -146,6 +163,25 @@ STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY')
 STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET')
 STRIPE_CONNECT_WEBHOOK_SECRET = config('STRIPE_CONNECT_WEBHOOK_SECRET', default=None)
 
+# Celery (background jobs). Use the broker from `CELERY_BROKER_URL` when set (e.g. in Docker).
+# Otherwise run tasks eagerly in-process so local dev works without a worker.
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL')
+CELERY_TASK_ALWAYS_EAGER = not CELERY_BROKER_URL
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BEAT_SCHEDULE = {
+    # Backfill invoice PDF links for payments whose webhook arrived without one
+    'fill-missing-invoice-pdfs': {
+        'task': 'billing.tasks.fill_missing_invoice_pdfs',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    # Keep the webhook dedup table bounded to Stripe's redelivery window
+    'prune-processed-stripe-events': {
+        'task': 'billing.tasks.prune_processed_stripe_events',
+        'schedule': crontab(hour=3, minute=30),
+    },
+}
+
 # Use a custom user model for subscription integration
 AUTH_USER_MODEL = 'billing.User'
 